@@ -0,0 +1,300 @@
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import scipy
+import user_knn as ukn
+import argparse
+
+""""
+Benchmark of the stages of the user based collaborative filtering pipeline of user_knn.py. Each stage runs in
+isolation, in a single process, on the given data sets:
+ml100k -> data/ml100k/ratings.csv
+1M, 10M, 100M... -> synthetic interaction logs with that number of rows, generated once in data_dir
+
+For every stage the wall time, the peak RSS of the process up to the end of the stage and the throughput are
+stored in a JSON file, that can be compared with the one of another commit through --compare
+
+Stages
+startup -> python -c "import user_knn" and python user_knn.py --help, in fresh interpreters, reported as the
+           "startup" data set (best of --startup_runs runs)
+conversion -> save_interaction_store, only with --ingestion_mode binary
+ingestion -> interactions_importation
+urm -> urm_builder and the row-wise normalization
+similarity -> row_dealer on all the target users
+scoring -> batch_recommend (or recommend with --scoring_mode item)
+output -> write_recommendations
+
+The memory section of every data set reports the size of the URM and of the neighbours arrays with the chosen
+--precision, and how much they would take with 64 bit indices and values
+"""""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--datasets', type=str, nargs='+', default=["ml100k", "1M"])
+parser.add_argument('--output', type=str, default="target/benchmark/"
+                                                  + str(datetime.datetime.now()).replace(" ", "").
+                                                  replace(".", "").replace(":", "") + "benchmark.json")
+parser.add_argument('--compare', type=str, default=None)
+parser.add_argument('--data_dir', type=str, default="data/synthetic")
+parser.add_argument('--targets', type=int, default=10000)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--k', type=int, default=63)
+parser.add_argument('--rec_length', type=int, default=5)
+parser.add_argument('--block_size', type=int, default=1000)
+parser.add_argument('--ingestion_mode', type=str, default="columnar",
+                    choices=["dict", "columnar", "streaming", "binary", "parallel"])
+parser.add_argument('--memory_budget', type=int, default=1024)
+parser.add_argument('--number_of_cpu', type=int, default=None)
+parser.add_argument('--scoring_mode', type=str, default="batch", choices=["item", "batch"])
+parser.add_argument('--precision', type=str, default="float32", choices=["float32", "float64"])
+parser.add_argument('--startup_runs', type=int, default=5)
+parser.add_argument('--verbosity_level', type=str, default="Log")
+args = parser.parse_args()
+
+
+def dataset_files(dataset):
+    # Returns interactions file, target users file, delimiter and rating key of a data set, generating the
+    # synthetic ones when they are not in data_dir yet
+    if dataset == "ml100k":
+        return "data/ml100k/ratings.csv", None, ',', "rating"
+    rows = parse_size(dataset)
+    interactions = os.path.join(args.data_dir, "interactions_" + dataset + ".csv")
+    target_users = os.path.join(args.data_dir, "target_users_" + dataset + "_" + str(args.targets) + ".csv")
+    if not os.path.exists(interactions):
+        synthetic_interactions(interactions, rows, args.seed)
+    if not os.path.exists(target_users):
+        synthetic_target_users(target_users, interactions, args.targets, args.seed)
+    return interactions, target_users, '\t', "rating"
+
+
+def parse_size(size):
+    # "500K" -> 500000, "10M" -> 10000000
+    multipliers = {"K": 10**3, "M": 10**6, "G": 10**9}
+    if size[-1].upper() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].upper()])
+    return int(size)
+
+
+def synthetic_interactions(filename, rows, seed=0, chunk_rows=10**6):
+    # Writes a tab separated interaction log with rows lines, in chunks of chunk_rows lines. Users are uniform,
+    # while the popularity of the items follows a Zipf law, as in real logs. There are about 20 interactions per
+    # user and 50 per item
+    ukn.time_print("Generating ", str(rows), " synthetic interactions in ", filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    generator = np.random.RandomState(seed)
+    user_number = max(rows // 20, 1)
+    item_number = max(rows // 50, 1)
+    with open(filename + ".tmp", 'w') as f:
+        f.write("user_id\titem_id\trating\tts\n")
+        for start in range(0, rows, chunk_rows):
+            size = min(chunk_rows, rows - start)
+            pd.DataFrame({"user_id": generator.randint(0, user_number, size),
+                          "item_id": (generator.zipf(1.3, size) - 1) % item_number,
+                          "rating": generator.randint(1, 6, size),
+                          "ts": generator.randint(10**9, 2 * 10**9, size)}).to_csv(f, sep='\t', header=False,
+                                                                                    index=False)
+    # Renamed only once complete, so an interrupted generation is not reused
+    os.rename(filename + ".tmp", filename)
+
+
+def synthetic_target_users(filename, interactions, targets, seed=0):
+    # Writes a target users file with targets users drawn among the ones of the interaction log
+    users = pd.unique(pd.read_csv(interactions, delimiter='\t', usecols=["user_id"])["user_id"].values)
+    generator = np.random.RandomState(seed)
+    chosen = generator.choice(users, min(targets, len(users)), replace=False)
+    pd.DataFrame({"user_id": chosen}).to_csv(filename, sep='\t', index=False)
+
+
+def measure(stages, stage, units, unit_name, function, *arguments):
+    # Runs function, appending to stages its wall time, the peak RSS of the process and the throughput
+    start = time.perf_counter()
+    result = function(*arguments)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    stages.append({"stage": stage, "seconds": seconds, "peak_rss_mb": peak_rss,
+                   "throughput": units / seconds if seconds > 0 else None, "unit": unit_name})
+    ukn.time_print("[", stage, "] ", str(round(seconds, 3)) + "s, ", str(round(peak_rss)) + "MB peak RSS")
+    return result
+
+
+def startup_report():
+    # Startup time of user_knn.py, measured in fresh interpreters so that no module is already imported: the import
+    # alone and the --help of the command line. The best of --startup_runs runs is kept, and the peak RSS is the one
+    # of the largest child process
+    directory = os.path.dirname(os.path.abspath(ukn.__file__))
+    commands = [("import", [sys.executable, "-c", "import user_knn"]),
+                ("help", [sys.executable, "user_knn.py", "--help"])]
+    stages = []
+    for stage, command in commands:
+        seconds = float("inf")
+        for _ in range(max(args.startup_runs, 1)):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+            seconds = min(seconds, time.perf_counter() - start)
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        stages.append({"stage": stage, "seconds": seconds, "peak_rss_mb": peak_rss, "throughput": None, "unit": None})
+        ukn.time_print("[", stage, "] ", str(round(seconds, 3)) + "s, ", str(round(peak_rss)) + "MB peak RSS")
+    return {"dataset": "startup", "stages": stages}
+
+
+def run_dataset(dataset, results_queue):
+    # Runs all the stages on a data set, putting the report in results_queue. Each data set runs in its own process
+    # so that its peak RSS is not affected by the previous ones
+    interactions, target_users_file, delimiter, rating_key = dataset_files(dataset)
+    stages = []
+
+    # In binary mode the one-time conversion is measured on its own, the ingestion stage only loads the store
+    interaction_store = os.path.splitext(interactions)[0] + ".store"
+    if args.ingestion_mode == "binary":
+        measure(stages, "conversion", 0, "interactions/s", ukn.save_interaction_store, interaction_store,
+                interactions, "user_id", "item_id", rating_key, "ts", delimiter, args.memory_budget)
+
+    (row_ind, col_ind, values), row_number, col_number, target_users, user_index, item_index = \
+        measure(stages, "ingestion", 0, "interactions/s", ukn.interactions_importation, interactions,
+                target_users_file, "user_id", "item_id", rating_key, args.ingestion_mode, delimiter, args.memory_budget,
+                interaction_store, "ts", args.number_of_cpu)
+    # The number of interactions is known only once they are read
+    interactions_number = len(values)
+    for stage in stages:
+        stage["throughput"] = interactions_number / stage["seconds"]
+
+    def build():
+        matrix = ukn.urm_builder((row_ind, col_ind, values), row_number, col_number, target_users, user_index,
+                                 precision=args.precision)
+        return ukn.l2_normalize(matrix)
+    user_rating_matrix = measure(stages, "urm", interactions_number, "interactions/s", build)
+
+    # As in user_knn.py the target users without interactions are left out of the similarity and scoring stages,
+    # they get the popularity fallback in the scoring stage. Throughputs are still per target user
+    profiled = ukn.profiled_targets(user_rating_matrix, user_index, target_users)
+    profiled_users = np.asarray(target_users)[profiled]
+    target_index = ukn.IdIndex(profiled_users)
+    # The synthetic data sets and ml100k have no expired items
+    expired_columns = ukn.expired_mask([], item_index)
+    popularity = ukn.popularity_ranking(user_rating_matrix, expired_columns)
+    neighbour_indices, neighbour_weights = \
+        measure(stages, "similarity", len(target_users), "users/s", ukn.row_dealer, user_rating_matrix,
+                profiled_users, user_index, "Similarity", args.k, args.block_size)
+
+    def score():
+        if args.scoring_mode == "batch":
+            recommendations, non_profiled_users = \
+                ukn.batch_recommend((neighbour_indices, neighbour_weights), user_rating_matrix, profiled_users,
+                                    target_index, user_index, item_index, args.rec_length, expired_columns,
+                                    popularity, "Scoring", args.block_size)
+        else:
+            recommendations, non_profiled_users = \
+                ukn.recommend((neighbour_indices, neighbour_weights), user_rating_matrix, profiled_users,
+                              target_index, user_index, item_index, args.rec_length, expired_columns,
+                              popularity, "Scoring", args.block_size)
+        recommendations.update(ukn.fallback_recommendations(np.asarray(target_users)[~profiled], popularity,
+                                                            item_index, args.rec_length))
+        return recommendations
+    rec_dictionary = measure(stages, "scoring", len(target_users), "users/s", score)
+
+    with tempfile.TemporaryDirectory() as directory:
+        measure(stages, "output", len(target_users), "users/s", ukn.write_recommendations, rec_dictionary,
+                target_users, "user_id", "recommended_items", ',', '\t', os.path.join(directory, "predictions.csv"))
+
+    results_queue.put({"dataset": dataset, "interactions": interactions_number, "users": row_number,
+                       "items": col_number, "target_users": len(target_users),
+                       "non_profiled_targets": int(np.count_nonzero(~profiled)), "stages": stages,
+                       "memory": memory_report(user_rating_matrix, neighbour_indices, neighbour_weights)})
+
+
+def memory_report(user_rating_matrix, neighbour_indices, neighbour_weights):
+    # Size in MB of the URM and of the neighbours arrays, compared with the one they would have with int64 indices
+    # and float64 values
+    megabyte = 1024.0 ** 2
+    urm = (user_rating_matrix.data.nbytes + user_rating_matrix.indices.nbytes + user_rating_matrix.indptr.nbytes)
+    urm_64 = 8 * (len(user_rating_matrix.data) + len(user_rating_matrix.indices) + len(user_rating_matrix.indptr))
+    neighbours = neighbour_indices.nbytes + neighbour_weights.nbytes
+    neighbours_64 = 8 * (neighbour_indices.size + neighbour_weights.size)
+    report = {"urm_mb": urm / megabyte, "neighbours_mb": neighbours / megabyte, "urm_64_mb": urm_64 / megabyte,
+              "neighbours_64_mb": neighbours_64 / megabyte,
+              "saved_mb": (urm_64 + neighbours_64 - urm - neighbours) / megabyte}
+    ukn.time_print("URM ", str(round(report["urm_mb"], 1)), "MB, neighbours ", str(round(report["neighbours_mb"], 1)),
+                   "MB, ", str(round(report["saved_mb"], 1)) + "MB saved over 64 bit indices and values")
+    return report
+
+
+def compare(old_report, new_report):
+    # Prints, for each data set and stage present in both reports, the ratio between the new and the old wall time
+    # and peak RSS. Ratios above 1 are regressions
+    old_stages = {(dataset["dataset"], stage["stage"]): stage
+                  for dataset in old_report["datasets"] for stage in dataset["stages"]}
+    print("dataset".ljust(10), "stage".ljust(12), "old s".rjust(10), "new s".rjust(10), "time x".rjust(8),
+          "old MB".rjust(10), "new MB".rjust(10), "rss x".rjust(8))
+    for dataset in new_report["datasets"]:
+        for stage in dataset["stages"]:
+            old = old_stages.get((dataset["dataset"], stage["stage"]))
+            if old is None:
+                continue
+            print(dataset["dataset"].ljust(10), stage["stage"].ljust(12), ("%.3f" % old["seconds"]).rjust(10),
+                  ("%.3f" % stage["seconds"]).rjust(10),
+                  ("%.2f" % (stage["seconds"] / max(old["seconds"], 1e-9))).rjust(8),
+                  ("%.0f" % old["peak_rss_mb"]).rjust(10), ("%.0f" % stage["peak_rss_mb"]).rjust(10),
+                  ("%.2f" % (stage["peak_rss_mb"] / max(old["peak_rss_mb"], 1e-9))).rjust(8))
+
+
+def current_commit():
+    # Hash of the checked out commit, None outside of a git repository
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    # Setting the timers and the verbosity of the pipeline
+    ukn.args.verbosity_level = args.verbosity_level
+    ukn.last_time = int(round(time.time() * 1000))
+    ukn.time_offset = ukn.last_time
+
+    report = {"commit": current_commit(), "date": str(datetime.datetime.now()), "python": platform.python_version(),
+              "numpy": np.__version__, "scipy": scipy.__version__, "pandas": pd.__version__,
+              "options": vars(args), "datasets": []}
+    # The startup is measured before the data sets, whose processes would otherwise set the peak RSS of the children
+    ukn.time_print("Benchmarking the startup")
+    report["datasets"].append(startup_report())
+    for dataset in args.datasets:
+        ukn.time_print("Benchmarking ", dataset)
+        results_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_dataset, args=(dataset, results_queue))
+        process.start()
+        # The report is read while the process is alive, a process that crashed leaves the queue empty
+        result = None
+        while result is None and (process.is_alive() or not results_queue.empty()):
+            try:
+                result = results_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        process.join()
+        if process.exitcode != 0 or result is None:
+            ukn.time_print("The benchmark of ", dataset, " failed")
+            continue
+        report["datasets"].append(result)
+
+    if os.path.dirname(args.output) != "":
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    ukn.time_print("Benchmark stored in ", args.output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,55 @@
 import datetime
+import hashlib
+import importlib.util
+import io
+import json
 import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 import threading
 import time
-import yaml
+import weakref
 import numpy as np
-import pandas as pd
-import scipy.sparse as sps
-from colorama import Fore, Style
-from sklearn.preprocessing import normalize
-import itertools as it
+from multiprocessing import shared_memory
 import argparse
 
+
+def lazy_import(name):
+    # Module name, executed only when one of its attributes is first read: importing this module (for --help, or
+    # from another script that only needs a few functions) does not pay for pandas and scipy
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import("pandas")
+sps = lazy_import("scipy.sparse")
+
 lock = threading.Lock()
 last_time = 0
 time_offset = 0
+# Shared memory segments created or attached by this process, and matrices already attached, by segment name
+shared_segments = {}
+attached_matrices = {}
+# Function and arguments common to all the chunks, set in each worker by the pool initializer
+worker_task = {}
+# Approximate memory needed to read and aggregate one interaction in streaming mode: parsed columns, codes, keys
+STREAMING_BYTES_PER_ROW = 200
+# Byte ranges parsed for each worker in parallel ingestion: more ranges than workers balance the load
+PARSING_RANGES_PER_CPU = 4
+# Type of the row/column indices of all the matrices and arrays of neighbours, the type of their values is chosen
+# by the precision argument (float32 by default, float64 for debugging)
+INDEX_DTYPE = np.int32
+# Types of the columns of the binary interaction store
+STORE_DTYPES = {"user": "<i4", "item": "<i4", "rating": "<f8", "time": "<i8"}
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--rating_file', type=str, default="data/competition/interactions.csv")
@@ -30,13 +66,32 @@ parser.add_argument('--prediction_file', type=str, default="target/competition/"
                                                            replace(".", "").replace(":", "") + "submission.csv")
 parser.add_argument('--user_bias', type=bool, default=True)
 parser.add_argument('--item_bias', type=bool, default=True)
+parser.add_argument('--user_bias_damping', type=float, default=0)
+parser.add_argument('--item_bias_damping', type=float, default=0)
 parser.add_argument('--rec_length', type=int, default=5)
 parser.add_argument('--verbosity_level', type=str, default="Info")
-parser.add_argument('--number_of_cpu', type=int, default=4)
+parser.add_argument('--number_of_cpu', type=int, default=None)
+parser.add_argument('--chunk_size', type=int, default=250)
+parser.add_argument('--scoring_mode', type=str, default="batch", choices=["item", "batch"])
+parser.add_argument('--cache_dir', type=str, default="cache")
 parser.add_argument('--urm_file', type=str, default=None)
 parser.add_argument('--similarity_matrix_file', type=str, default=None)
 parser.add_argument('--estimations_file', type=str, default=None)
-args = parser.parse_args()
+parser.add_argument('--ingestion_mode', type=str, default="columnar",
+                    choices=["dict", "columnar", "streaming", "binary", "parallel"])
+parser.add_argument('--memory_budget', type=int, default=1024)
+# Binary columnar store of the interactions, by default next to the rating file with the .store extension
+parser.add_argument('--interaction_store', type=str, default=None)
+parser.add_argument('--time_key', type=str, default="created_at")
+parser.add_argument('--precision', type=str, default="float32", choices=["float32", "float64"])
+parser.add_argument('--delta_files', type=str, nargs='*', default=[])
+parser.add_argument('--block_size', type=int, default=1000)
+parser.add_argument('--share_mode', type=str, default="shm", choices=["pickle", "shm", "mmap"])
+parser.add_argument('--delimiter', type=str, default='\t')
+parser.add_argument('--item_profile_file', type=str, default="data/competition/item_profile.csv")
+# Importing the module does not read the command line: the options keep their defaults until the module is run
+# as a script
+args = parser.parse_args([])
 
 """"
 Some useful definitions to understand the code base
@@ -45,13 +100,90 @@ Target_users -> array of the users that are the target of our recommendations
 Interacting_users -> array of the users that have at least one interaction
 
 Function Interfaces
+def lazy_import(name)
 def time_print(string1, string2="", string3="", string4="", string5="", string6="", style="Log")
 def user_knn(interactions, target_users_file=None, k=50, user_key="user_id", item_key="item_id")
-def row_dealer(user_rating_matrix, target_users, uid_position_dic, task_name, offset=0, k=50)
-def mapper(array, subject="the given input")
+def profiled_targets(user_rating_matrix, user_index, target_users)
+def target_rows(user_index, target_users)
+def row_dealer(user_rating_matrix, target_users, user_index, task_name, k=50, block_size=1000, neighbours=None,
+               rows=None)
+def block_top_k(block, k)
+def rows_top_k(rows, cols, values, k)
+def neighbours_block(neighbour_indices, neighbour_weights, rows, user_number)
+def share_arrays(arrays, share_mode="shm", directory=None)
+def allocate_arrays(shapes, share_mode="shm", directory=None)
+def attach_arrays(described, writable=False)
+def share_matrix(matrix, share_mode="shm", layouts=("csr", "csc", "binary"))
+def attach_matrix(descriptor, layout="csr")
+def share_neighbours(neighbours, share_mode="shm")
+def allocate_neighbours(shape, dtype, share_mode="shm", path=None)
+def attach_neighbours(descriptor, writable=False)
+def release_shared(descriptor)
+def schedule(function, arguments, chunks, number_of_cpu=None)
+def artifact_key(files, parameters)
+def artifact_path(explicit_path, cache_dir, prefix, key, extension=".npz")
+def save_artifact(path, key, matrix, **arrays)
+def load_artifact(path, key)
+def unpack_urm_artifact(artifact)
+def save_neighbours(path, key, neighbour_indices, neighbour_weights)
+def seal_neighbours(path, key)
+def load_neighbours(path, key)
+class IdIndex(ids)
+class Adjacency(user_rating_matrix)
+def as_adjacency(user_rating_matrix)
+def read_only(view)
 def data_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
+def columnar_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
+def streaming_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
+def grow_index(index, ids)
+def merge_aggregates(aggregates)
+def parallel_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
+def byte_ranges(f, start, size, parts)
+def parse_range(interactions, start, end, names, usecols, delimiter='\t')
+def binary_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
+def save_interaction_store(path, interactions, user_key="user_id", item_key="item_id", rating_key="rating")
+def load_interaction_store(path, interactions=None, user_key="user_id", item_key="item_id", rating_key="rating")
+def store_source(interactions)
+def aggregate_interactions(row_ind, col_ind, ratings, row_number, col_number)
+def interactions_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
 def urm_computer(interactions, target_users_file=None, user_key="user_id", item_key="item_id")
-def recommend(similarity_matrix, user_rating_matrix, target_users,)
+def urm_builder(coo_arrays, row_number, col_number, target_users, user_index)
+def l2_normalize(matrix)
+def remove_biases(user_rating_matrix, _user_bias_=1, _item_bias_=1, user_damping=0, item_damping=0)
+def urm_statistics(coo_arrays, row_number, col_number, _user_bias_=1, user_damping=0)
+def bias_averages(statistics, kind, bias=1, damping=0)
+def urm_update(user_rating_matrix, statistics, target_users, user_index, item_index, delta_file)
+def grow(array, length)
+def row_positions(indptr, rows)
+def recommend(neighbours, user_rating_matrix, target_users, target_index, user_index, item_index, rec_length,
+              expired_columns, popularity, name="Generic Rec-Sys", block_size=1000)
+def recommend_arrays(neighbours, user_rating_matrix, target_users, target_index, user_index, rec_length,
+                     expired_columns, popularity, name="Generic Rec-Sys", block_size=1000)
+def batch_recommend(neighbours, user_rating_matrix, target_users, target_index, user_index, item_index,
+                    rec_length, expired_columns, popularity)
+def batch_recommend_arrays(neighbours, user_rating_matrix, target_users, target_index, user_index, rec_length,
+                           expired_columns, popularity)
+def block_recommendations(candidates, estimated_ratings, popular_columns)
+def top_n(indptr, values, n)
+def merge_popular(columns, scores, popular_columns)
+def recommended_items(columns, item_index)
+def recommendation_lists(items, scores)
+def binarized(matrix)
+def candidate_items(similarity_block, binary_urm, seen_block, expired_columns)
+def sparse_values_at(matrix, pattern)
+def check_expiration(filename="data/competition/item_profile.csv")
+def expired_mask(expired_items, item_index)
+def popularity_ranking(user_rating_matrix, expired_columns)
+def popular_unseen(popularity, seen_rows, rec_length)
+def non_personalized_recommendation(popular_columns, item_index)
+def fallback_recommendations(users, popularity, item_index, rec_length)
+class UserKNNRecommender(k=63, rec_length=5, user_key="user_id", item_key="item_id", rating_key="rating", ...)
+    def fit(self, interactions, target_users_file=None)
+    def recommend(self, user_ids)
+    def recommend_batch(self, user_ids)
+    def user_neighbours(self, user_ids)
+    def recommend_targets(self)
+    def release(self)
 def main(interactions, target_users_file=None, k=50, hold_out_percentage=0.8, prediction_file=None,
              ask_to_go=False, interaction_logic=0, user_key="user_id", item_key="item_id")
 """""
@@ -59,6 +191,7 @@ def main(interactions, target_users_file=None, k=50, hold_out_percentage=0.8, pr
 
 def time_print(string1, string2="", string3="", string4="", string5="", string6="", style="Log"):
     # This function is needed to print also the ex time of the task (approx)
+    from colorama import Fore, Style
     verbosity_levels = ["None", "Log", "Info", "Tips"]
     lock.acquire()
     global last_time
@@ -79,200 +212,623 @@ def time_print(string1, string2="", string3="", string4="", string5="", string6=
 
 
 def user_knn(interactions, target_users_file=None, k=50, user_key="user_id", item_key="item_id", rating_key="rating",
-             _item_bias_=1, _user_bias_=1):
+             _item_bias_=1, _user_bias_=1, ingestion_mode="dict", block_size=1000, share_mode="pickle",
+             number_of_cpu=None, cache_dir=None, urm_file=None, similarity_matrix_file=None, user_damping=0,
+             item_damping=0, delimiter='\t', memory_budget=1024, interaction_store=None, time_key="created_at",
+             precision="float32", delta_files=(), normalize_rows=True):
     # This function is called in order to test or recommend using an user based collaborative filtering approach
-    time_print("Building the URM...")
+
+    # The URM and the similarity matrix are reused from a previous run when an artifact built from the same input
+    # files and with the same parameters is found (in cache_dir or in the explicitly given files). Without any of
+    # them nothing is persisted and no key is computed
+    persisted = cache_dir is not None or urm_file is not None or similarity_matrix_file is not None
+    urm_key = None
+    if persisted:
+        urm_key = artifact_key([interactions, target_users_file], [user_key, item_key, rating_key, _user_bias_,
+                                                                    _item_bias_, normalize_rows, user_damping,
+                                                                    item_damping, delimiter, precision])
+    urm_path = artifact_path(urm_file, cache_dir, "urm", urm_key)
+    urm_artifact = load_artifact(urm_path, urm_key)
 
     # User rating matrix : sparse matrix with row_number rows and col_number columns
     # rows are users, columns are items
     # target users are the users for which we want to provide recommendations
-    # position uid dic : dictionary associating to a row the corresponding user id
-    # uid position : the symmetric
-    # position iid dic : dictionary associating to a row the corresponding item id
-    # iid position : the symmetric
-    # user_rated_items is the dictionary in which for each user are listed all the ids of the items that he rated
-    user_rating_matrix, target_users, users, position_uid_dic, uid_position_dic, position_iid_dic, iid_position_dic,\
-        row_number, col_number, user_rated_items, item_rating_user = urm_computer(interactions, target_users_file,
-                                                                                  user_key, item_key,
-                                                                                  _item_bias_=_item_bias_,
-                                                                                  rating_key=rating_key,
-                                                                                  _user_bias_=_user_bias_)
-    time_print("URM Successfully built")
-
-    if args.normalize:
-        # Normalization of the matrix. Row wise
-        time_print("Starting the row-wise normalization", style="Info")
-        user_rating_matrix = normalize(user_rating_matrix, 'l2', 1, copy=False)
-        time_print("Normalization successfully completed")
-
-    # Now it starts the computation of the similarity matrix
-    # In order to improve performances 4 workers will be used to perform the task
-    tot = len(target_users)
-    pool = multiprocessing.Pool()
-    step = int(tot/4)
-
-    # The matrix is supposed to be squared (all users * all users) but in order to
-    # improve performances we eliminate all the unused rows, keeping only the rows
-    # corresponding to the target users.
-
-    # The task of computing the matrix is split between 4 child processes
-    first_block = pool.apply_async(row_dealer, (user_rating_matrix, target_users[:step],
-                                                uid_position_dic, "One", 0, k,))
-    second_block = pool.apply_async(row_dealer, (user_rating_matrix, target_users[step:2*step],
-                                                 uid_position_dic, "Two", step, k,))
-    third_block = pool.apply_async(row_dealer, (user_rating_matrix, target_users[2*step:3*step],
-                                                uid_position_dic, "Three", 2*step, k,))
-    fourth_block = pool.apply_async(row_dealer, (user_rating_matrix, target_users[3*step:],
-                                                 uid_position_dic, "Four", 3*step, k,))
-
-    # Fetching of the results from the workers who run the tasks
-    first_data, first_row_ind, first_col_ind, first_new_uid_position_partial, first_similar_users_id\
-        = first_block.get()
-    second_data, second_row_ind, second_col_ind, second_new_uid_position_partial, second_similar_users_id \
-        = second_block.get()
-    third_data, third_row_ind, third_col_ind, third_new_uid_position_partial, third_similar_users_id \
-        = third_block.get()
-    fourth_data, fourth_row_ind, fourth_col_ind, fourth_new_uid_position_partial, fourth_similar_users_id \
-        = fourth_block.get()
-
-    # Merging the results obtained by the workers
-    time_print("Merging the results obtained by the workers...", style="Info")
-
-    # all the elements of the matrix obtaining stacking the partial results obtained by the w
-    final_data = np.hstack((first_data, second_data))
-    final_data = np.hstack((final_data, third_data))
-    final_data = np.hstack((final_data, fourth_data))
-    time_print("Merged values", style="Log")
-
-    # all the row indices of the matrix obtaining stacking the partial results obtained by the w
-    final_row_ind = np.hstack((first_row_ind, second_row_ind))
-    final_row_ind = np.hstack((final_row_ind, third_row_ind))
-    final_row_ind = np.hstack((final_row_ind, fourth_row_ind))
-    time_print("Merged row indices", style="Log")
-
-    # all the column indices of the matrix obtaining stacking the partial results obtained by the w
-    final_col_ind = np.hstack((first_col_ind, second_col_ind))
-    final_col_ind = np.hstack((final_col_ind, third_col_ind))
-    final_col_ind = np.hstack((final_col_ind, fourth_col_ind))
-    time_print("Merged column indices", style="Log")
-
-    # all the ids of similar users for each user obtained stacking the partial results obtained by the w
-    similar_users_id = dict(first_similar_users_id)
-    similar_users_id.update(second_similar_users_id)
-    similar_users_id.update(third_similar_users_id)
-    similar_users_id.update(fourth_similar_users_id)
-    time_print("Merged similar users dictionary", style="Log")
-
-    # The new mapping user -> position in which only target users are present
-    new_uid_position = dict(first_new_uid_position_partial)
-    new_uid_position.update(second_new_uid_position_partial)
-    new_uid_position.update(third_new_uid_position_partial)
-    new_uid_position.update(fourth_new_uid_position_partial)
-    time_print("Merged position dictionary", style="Log")
-
-    time_print("Merging process completed! The matrix is built for ", str(len(new_uid_position)), " users.")
-    time_print("Transforming the matrix into a sparse matrix", style="Info")
-
-    # The similarity matrix is the sparse matrix target_users * users in which are stored the similarities
-    similarity_matrix = sps.csc_matrix((final_data, (final_row_ind, final_col_ind)), shape=(tot, row_number))
-
-    pool.close()
-    pool.terminate()
-
-    return target_users, similarity_matrix, new_uid_position, user_rating_matrix, position_iid_dic,\
-        position_uid_dic, iid_position_dic, uid_position_dic, row_number, col_number, similar_users_id,\
-        user_rated_items, item_rating_user
-
-
-def row_dealer(user_rating_matrix, target_users, uid_position_dic, task_name, offset=0, k=50):
-    # This function retrieves a set of rows with the similarity between a bunch of users and all the others
+    # user index : IdIndex associating the rows to the corresponding user ids, and the other way round
+    # item index : IdIndex associating the columns to the corresponding item ids, and the other way round
+    # the items rated by each user and the users that rated each item are read from the URM through Adjacency
+    # urm_state contains the sufficient statistics of the URM needed to update it with the delta files
+    if urm_artifact is not None and len(delta_files) > 0 and "raw" not in urm_artifact[1]:
+        time_print("Ignoring ", urm_path, ": it was saved without the statistics needed by the delta files",
+                   style="Info")
+        urm_artifact = None
+    if urm_artifact is not None:
+        time_print("Loading the URM from ", urm_path, style="Info")
+        user_rating_matrix, target_users, user_index, item_index, urm_state = unpack_urm_artifact(urm_artifact)
+    else:
+        time_print("Building the URM...")
+        user_rating_matrix, target_users, user_index, item_index, row_number, col_number, urm_state = \
+            urm_computer(interactions, target_users_file, user_key, item_key, _item_bias_=_item_bias_,
+                         rating_key=rating_key, _user_bias_=_user_bias_, ingestion_mode=ingestion_mode,
+                         user_damping=user_damping, item_damping=item_damping, delimiter=delimiter,
+                         memory_budget=memory_budget, interaction_store=interaction_store, time_key=time_key,
+                         number_of_cpu=number_of_cpu, precision=precision)
+        time_print("URM Successfully built")
+
+        if normalize_rows:
+            # Normalization of the matrix. Row wise
+            time_print("Starting the row-wise normalization", style="Info")
+            user_rating_matrix = l2_normalize(user_rating_matrix)
+            time_print("Normalization successfully completed")
+
+        if urm_path is not None:
+            time_print("Saving the URM in ", urm_path, style="Info")
+            save_artifact(urm_path, urm_key, user_rating_matrix, target_users=np.asarray(target_users),
+                          users=user_index.ids, items=item_index.ids, **urm_state)
+
+    # The delta files are applied in order, each one on the URM updated with the previous ones. Every updated URM
+    # is an artifact of its own, identified by the delta file and by the key of the URM it was applied on: on a
+    # daily refresh only the last delta is actually read
+    for delta_file in delta_files:
+        delta_key = artifact_key([delta_file], [urm_key]) if persisted else None
+        delta_path = artifact_path(None, cache_dir, "urm", delta_key)
+        delta_artifact = load_artifact(delta_path, delta_key)
+        if delta_artifact is not None:
+            time_print("Loading the URM updated with ", delta_file, " from ", delta_path, style="Info")
+            user_rating_matrix, target_users, user_index, item_index, urm_state = \
+                unpack_urm_artifact(delta_artifact)
+        else:
+            time_print("Updating the URM with ", delta_file)
+            user_rating_matrix, target_users, user_index, item_index, urm_state = \
+                urm_update(user_rating_matrix, urm_state, target_users, user_index, item_index, delta_file,
+                           target_users_file is None, user_key, item_key, rating_key, _user_bias_, _item_bias_,
+                           user_damping, item_damping, delimiter, normalize_rows, precision)
+            if delta_path is not None:
+                time_print("Saving the updated URM in ", delta_path, style="Info")
+                save_artifact(delta_path, delta_key, user_rating_matrix, target_users=np.asarray(target_users),
+                              users=user_index.ids, items=item_index.ids, **urm_state)
+        urm_key = delta_key
+    row_number, col_number = user_rating_matrix.shape
+
+    # Unless the pickle mode is requested, the URM is copied once in shared memory (or in memory mapped files)
+    # and the workers receive only a descriptor to attach to it, instead of a full copy of the matrix each
+    shared_urm = None
+    urm_argument = None
+    if share_mode != "pickle":
+        time_print("Sharing the URM with the workers (", share_mode, ")", style="Info")
+        shared_urm = share_matrix(user_rating_matrix, share_mode)
+        urm_argument = shared_urm
+
+    # From here on the shared memory created by this function is freed if anything goes wrong, otherwise it is
+    # returned to the caller, that releases it once the workers are done
+    shared_neighbours = None
+    try:
+        tot = len(target_users)
+        # The rows of the neighbours arrays follow the order of the target users
+        target_index = IdIndex(target_users)
+        # The similarity matrix is stored as the k nearest neighbours of every target user: two dense arrays
+        # target_users * k with the positions of the neighbours in the URM and their similarity weights
+        neighbours_key = artifact_key([], [urm_key, k]) if persisted else None
+        neighbours_path = artifact_path(similarity_matrix_file, cache_dir, "neighbours", neighbours_key, extension="")
+        # The target users without interactions, found once with a boolean mask, are returned to the later stages
+        profiled = profiled_targets(user_rating_matrix, user_index, target_users)
+        neighbours = load_neighbours(neighbours_path, neighbours_key)
+        if neighbours is not None:
+            time_print("Memory mapping the nearest neighbours from ", neighbours_path, style="Info")
+            return target_users, target_index, profiled, neighbours, user_rating_matrix, user_index, item_index, \
+                row_number, col_number, shared_urm, None
+
+        # Now it starts the computation of the similarity matrix
+        # The target users are split in chunks of block_size users, each one is a task for the scheduler
+
+        # The matrix is supposed to be squared (all users * all users) but in order to
+        # improve performances we eliminate all the unused rows, keeping only the rows
+        # corresponding to the target users.
+        # The target users without interactions have no neighbours: they are left out of the computation and their rows
+        # of the neighbours arrays stay empty
+        profiled_users = np.asarray(target_users)[profiled]
+        time_print(str(tot - len(profiled_users)), " target users have no interactions, no neighbours are computed ",
+                   "for them", style="Info")
+        profiled_rows = np.flatnonzero(profiled)
+        chunks = [{"target_users": profiled_users[start:start+block_size],
+                   "rows": profiled_rows[start:start+block_size], "task_name": "Block " + str(start // block_size)}
+                  for start in range(0, len(profiled_users), block_size)]
+        # In pickle mode the layouts of the URM are built here, once, and sent once to each worker
+        if urm_argument is None:
+            urm_argument = Adjacency(user_rating_matrix)
+        arguments = {"user_rating_matrix": urm_argument, "user_index": user_index, "k": k, "block_size": block_size}
+
+        # The neighbours arrays are allocated once for all the target users, in shared memory or directly in the files
+        # of the artifact, and the workers write the rows of their chunks in place: once they are done the arrays are
+        # complete, there is nothing to send back and to merge. In pickle mode the workers return their rows instead,
+        # copied once in the rows of the profiled target users
+        if share_mode != "pickle":
+            in_place = share_mode == "mmap" and neighbours_path is not None
+            shared_neighbours = allocate_neighbours((tot, k), user_rating_matrix.dtype, share_mode,
+                                                    neighbours_path if in_place else None)
+            arguments["neighbours"] = shared_neighbours
+            schedule(row_dealer, arguments, chunks, number_of_cpu)
+            neighbours = attach_neighbours(shared_neighbours)
+        else:
+            results = schedule(row_dealer, arguments, chunks, number_of_cpu)
+            time_print("Merging the results obtained by the workers...", style="Info")
+            neighbours = (np.zeros((tot, k), dtype=INDEX_DTYPE), np.zeros((tot, k), dtype=user_rating_matrix.dtype))
+            for chunk, (neighbour_indices, neighbour_weights) in zip(chunks, results):
+                neighbours[0][chunk["rows"]] = neighbour_indices
+                neighbours[1][chunk["rows"]] = neighbour_weights
+            del results
+
+        time_print("The neighbours are found for ", str(len(neighbours[0])), " users.")
+
+        # Once saved, the neighbours are read back memory mapped: the workers can then map the same files. The arrays
+        # already written in the files of the artifact only need its key
+        if neighbours_path is not None:
+            time_print("Saving the nearest neighbours in ", neighbours_path, style="Info")
+            if share_mode == "mmap":
+                del neighbours
+                release_shared(shared_neighbours)
+                seal_neighbours(neighbours_path, neighbours_key)
+            else:
+                save_neighbours(neighbours_path, neighbours_key, neighbours[0], neighbours[1])
+                del neighbours
+                release_shared(shared_neighbours)
+            shared_neighbours = None
+            neighbours = load_neighbours(neighbours_path, neighbours_key)
+
+        # The shared neighbours, when they are still in shared memory, are returned along with their descriptor: the
+        # recommendation workers attach to the same arrays
+        return target_users, target_index, profiled, neighbours, user_rating_matrix, user_index, item_index, \
+            row_number, col_number, shared_urm, shared_neighbours
+    except BaseException:
+        neighbours = None
+        release_shared(shared_neighbours)
+        release_shared(shared_urm)
+        raise
+
+
+def profiled_targets(user_rating_matrix, user_index, target_users):
+    # Boolean mask over the target users, True for the ones with at least one interaction (a row of the URM with
+    # some element). The others can only receive the non personalized recommendations
+    return user_rating_matrix.getnnz(axis=1)[user_index.encode(target_users)] > 0
+
+
+def target_rows(user_index, target_users):
+    # Boolean mask over the rows of the URM, True for the target users. Combined with the mask of the rows with some
+    # element it splits the users in groups (interacting, non profiled targets...) without any membership scan
+    mask = np.zeros(len(user_index), dtype=bool)
+    mask[user_index.encode(target_users)] = True
+    return mask
+
+
+def row_dealer(user_rating_matrix, target_users, user_index, task_name, k=50, block_size=1000, neighbours=None,
+               rows=None):
+    # This function retrieves a set of rows with the similarity between a bunch of users and all the others.
+    # The target rows are multiplied by the transposed URM block_size rows at a time, as sparse x sparse
+    # products, so the similarity rows are never densified. Bigger blocks use more RAM but less overhead.
+    # The k nearest neighbours of each user are written in a row of two arrays with k columns, the positions of the
+    # neighbours and their weights, padded with zero weights when less than k neighbours are found.
+    # neighbours is the descriptor of the arrays allocated by allocate_neighbours, and rows the rows of the target
+    # users in them: the worker writes its rows in place and returns nothing. Without it two arrays tot * k are
+    # allocated here and returned
     nonzero = 0
-    data = []
-    row_ind = []
-    col_ind = []
-    counter = 0
-    new_uid_position_partial = {}
-    transposed_urm = user_rating_matrix.transpose(copy=True)
+    # When the URM lives in shared memory both layouts are attached without copying anything, once per worker. In
+    # pickle mode the workers receive an Adjacency with the layouts already built by the parent
+    adjacency = as_adjacency(user_rating_matrix)
+    csr_urm = adjacency.csr
+    transposed_urm = adjacency.csc.transpose()
     tot = len(target_users)
-    similar_users_id = {}
-    # For each user computes the similarity with all the other by multiplying it to the transpose of the URM
-    for user in target_users:
-        # This is needed to have a dictionary with the new association row <-> id
-        new_uid_position_partial[user] = offset + counter
-        counter += 1
-        # Check the row of the table associated to the next target user
-        index = uid_position_dic[user]
-        row = user_rating_matrix.getrow(index)
-        # Performs the dot product and stores it into an array
-        similarity_product_array = np.asarray(row.dot(transposed_urm).toarray()[0].copy())
-        # We set to zero the similarity between the user and himself
-        similarity_product_array[index] = 0
+    if neighbours is None:
+        # The neighbours arrays follow the index type and the precision of the URM
+        neighbour_indices = np.zeros((tot, k), dtype=INDEX_DTYPE)
+        neighbour_weights = np.zeros((tot, k), dtype=csr_urm.dtype)
+        rows = np.arange(tot)
+    else:
+        neighbour_indices, neighbour_weights = attach_neighbours(neighbours, writable=True)
+    for start in range(0, tot, block_size):
+        block_users = target_users[start:start+block_size]
+        # Check the rows of the table associated to the block of target users
+        indices = user_index.encode(block_users)
+        # Performs the sparse product, one row of similarities for each user of the block
+        block = csr_urm[indices].dot(transposed_urm).tocsr()
+        # We set to zero the similarity between each user and himself
+        block_rows = np.repeat(np.arange(len(indices)), np.diff(block.indptr))
+        block.data[block.indices == indices[block_rows]] = 0
         # Counts the nonzero for analytics purposes
-        nonzero += len(similarity_product_array.nonzero()[0])
-        # Prints to show progress every 500 targets users processed
-        if counter % 500 == 0:
-            time_print("[", task_name, "]:", str(counter/tot*100), " % completed.", style="Info")
+        nonzero += np.count_nonzero(block.data)
+        # Prints to show progress every block processed
+        time_print("[", task_name, "]:", str(start/tot*100), " % completed.", style="Info")
         # Here we select the k-nearest-neighbours to store
-        k_nearest_indices = np.argpartition(similarity_product_array, -k)[-k:]
+        block_row_ind, block_col_ind, block_data = block_top_k(block, k)
 
-        # We store everything in 3 different arrays that will be used later to initialize a sparse matrix
-        similar_users_id[user] = k_nearest_indices.copy()
-        for iteration in range(0, k):
-            row_ind.append(new_uid_position_partial[user])
-            col_ind.append(k_nearest_indices[iteration])
-            data.append(similarity_product_array[k_nearest_indices[iteration]])
+        # Each neighbour goes in the column given by its rank inside the row
+        ranks = np.arange(len(block_row_ind)) - np.searchsorted(block_row_ind, block_row_ind)
+        neighbour_indices[rows[start + block_row_ind], ranks] = block_col_ind
+        neighbour_weights[rows[start + block_row_ind], ranks] = block_data
 
     # We print a message to show the completion of the task
     time_print("[", task_name, "]: 100 % completed.")
     # We add info related to the number of average similar items encountered
-    time_print("[", task_name, "]: in average were found ", str(nonzero/tot), "elements per row", style="Info")
+    time_print("[", task_name, "]: in average were found ", str(nonzero/max(tot, 1)), "elements per row", style="Info")
+
+    if neighbours is None:
+        return neighbour_indices, neighbour_weights
+
+
+def block_top_k(block, k):
+    # Selects the k greatest positive values of each row of a CSR block, returning them as COO arrays sorted
+    # by row. Implicit zeros would win against negative similarities, so only the positive ones are kept
+    block_rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    positive = block.data > 0
+    return rows_top_k(block_rows[positive], block.indices[positive], block.data[positive], k)
+
+
+def rows_top_k(rows, cols, values, k):
+    # Given a matrix as COO arrays, keeps the k greatest values of each row. The result is sorted by row and,
+    # inside each row, by decreasing value
+    # Sorting by row and then by decreasing value, the rank of an element is its distance from the row start
+    order = np.lexsort((-values, rows))
+    row_start = np.searchsorted(rows[order], rows[order], side='left')
+    order = order[np.arange(len(order)) - row_start < k]
+    return rows[order], cols[order], values[order]
+
+
+def neighbours_block(neighbour_indices, neighbour_weights, rows, user_number):
+    # Builds the similarity matrix restricted to the given rows of the neighbours arrays, as a CSR matrix
+    # len(rows) * user_number. Every row is a slice of the arrays, the zero weights used as padding are dropped
+    k = neighbour_indices.shape[1]
+    block = sps.csr_matrix((neighbour_weights[rows].ravel(), neighbour_indices[rows].ravel(),
+                            np.arange(len(rows) + 1) * k), shape=(len(rows), user_number))
+    block.eliminate_zeros()
+    return block
+
+
+def share_arrays(arrays, share_mode="shm", directory=None):
+    # Copies once every array of the dictionary in a shared memory segment ("shm") or in a .npy file of directory
+    # ("mmap"), returning the picklable description of the copies: name -> (mode, location, dtype, shape).
+    # Arrays already memory mapped from a .npy file are described by their file and not copied at all
+    described = {}
+    for name, array in arrays.items():
+        if isinstance(array, np.memmap) and array.filename is not None and array.filename.endswith(".npy"):
+            described[name] = ("mmap", array.filename, array.dtype.str, array.shape)
+        elif share_mode == "shm":
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[:] = array
+            shared_segments[segment.name] = segment
+            described[name] = ("shm", segment.name, array.dtype.str, array.shape)
+        else:
+            location = os.path.join(directory, name + ".npy")
+            np.save(location, array)
+            described[name] = ("mmap", location, array.dtype.str, array.shape)
+    return described
+
+
+def allocate_arrays(shapes, share_mode="shm", directory=None):
+    # Same description of share_arrays for zero filled arrays created directly in a shared memory segment ("shm")
+    # or in a .npy file of directory ("mmap"), given as name -> (shape, dtype). Nothing is copied: both new segments
+    # and new files are already filled with zeros
+    described = {}
+    for name, (shape, dtype) in shapes.items():
+        dtype = np.dtype(dtype)
+        if share_mode == "shm":
+            segment = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+            shared_segments[segment.name] = segment
+            described[name] = ("shm", segment.name, dtype.str, shape)
+        else:
+            location = os.path.join(directory, name + ".npy")
+            np.lib.format.open_memmap(location, mode='w+', dtype=dtype, shape=shape).flush()
+            described[name] = ("mmap", location, dtype.str, shape)
+    return described
+
+
+def attach_arrays(described, writable=False):
+    # Returns views on the arrays described by share_arrays, without copying them. The memory mapped files are
+    # opened read only unless writable is requested
+    views = {}
+    for name, (mode, location, dtype, shape) in described.items():
+        if mode == "shm":
+            if location not in shared_segments:
+                shared_segments[location] = shared_memory.SharedMemory(name=location)
+            views[name] = np.ndarray(shape, dtype=dtype, buffer=shared_segments[location].buf)
+        else:
+            views[name] = np.load(location, mmap_mode='r+' if writable else 'r')
+    return views
+
+
+def share_matrix(matrix, share_mode="shm", layouts=("csr", "csc", "binary")):
+    # Copies once the data, indices and indptr arrays of the matrix, for every requested layout, in shared memory
+    # segments ("shm") or in memory mapped .npy files ("mmap"). Returns a small picklable descriptor: the workers
+    # receive it instead of the matrix and use attach_matrix to read the same memory without any copy. The
+    # "binary" layout is binarized(matrix): only its data (all ones) is shared, it reads the indices and indptr of
+    # the "csr" layout
+    descriptor = {"shape": matrix.shape, "layouts": {}}
+    if share_mode == "mmap":
+        descriptor["directory"] = tempfile.mkdtemp(prefix="recsys_shared_")
+    for layout in layouts:
+        compressed = matrix.tocsc() if layout == "csc" else matrix.tocsr()
+        directory = None
+        if share_mode == "mmap":
+            directory = os.path.join(descriptor["directory"], layout)
+            os.makedirs(directory)
+        if layout == "binary":
+            arrays = {"data": np.ones(len(compressed.indices), dtype=compressed.dtype)}
+        else:
+            arrays = {"data": compressed.data, "indices": compressed.indices, "indptr": compressed.indptr}
+        descriptor["layouts"][layout] = share_arrays(arrays, share_mode, directory)
+    return descriptor
+
+
+def attach_matrix(descriptor, layout="csr"):
+    # Rebuilds a sparse matrix on top of the arrays described by share_matrix. Every process attaches to a
+    # matrix only once, the following calls return the matrix already built
+    key = descriptor["layouts"][layout]["data"][1]
+    if key in attached_matrices:
+        return attached_matrices[key]
+    views = attach_arrays(descriptor["layouts"][layout])
+    if layout == "binary":
+        csr = attach_matrix(descriptor, "csr")
+        views.update({"indices": csr.indices, "indptr": csr.indptr})
+    matrix_class = sps.csc_matrix if layout == "csc" else sps.csr_matrix
+    matrix = matrix_class(descriptor["shape"])
+    # The arrays are assigned directly, the constructor could otherwise copy them to change their dtype
+    matrix.data, matrix.indices, matrix.indptr = views["data"], views["indices"], views["indptr"]
+    attached_matrices[key] = matrix
+    return matrix
+
+
+def share_neighbours(neighbours, share_mode="shm"):
+    # Same as share_matrix for the (indices, weights) arrays of the nearest neighbours. When they are memory
+    # mapped from the cache the descriptor just points to those files
+    descriptor = {"layouts": {}}
+    directory = None
+    if share_mode == "mmap":
+        descriptor["directory"] = directory = tempfile.mkdtemp(prefix="recsys_shared_")
+    descriptor["layouts"]["neighbours"] = share_arrays({"indices": neighbours[0], "weights": neighbours[1]},
+                                                       share_mode, directory)
+    return descriptor
+
+
+def allocate_neighbours(shape, dtype, share_mode="shm", path=None):
+    # Allocates the zero filled (indices, weights) arrays of the nearest neighbours, shape = target users * k, in
+    # shared memory or in memory mapped files, returning the same descriptor of share_neighbours. The workers
+    # attach to it and write their rows in place, so no result travels back to the parent. In "mmap" mode the
+    # files are created directly in path, the directory of the cached artifact, when it is given
+    descriptor = {"layouts": {}}
+    directory = path
+    if share_mode == "mmap" and path is None:
+        descriptor["directory"] = directory = tempfile.mkdtemp(prefix="recsys_shared_")
+    elif share_mode == "mmap":
+        # Until the key is written again the directory is an incomplete artifact
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, "key")):
+            os.remove(os.path.join(path, "key"))
+    descriptor["layouts"]["neighbours"] = allocate_arrays({"indices": (shape, INDEX_DTYPE),
+                                                           "weights": (shape, dtype)}, share_mode, directory)
+    return descriptor
+
+
+def attach_neighbours(descriptor, writable=False):
+    # Returns the (indices, weights) arrays described by share_neighbours, attaching to them only once
+    key = descriptor["layouts"]["neighbours"]["indices"][1]
+    if key not in attached_matrices:
+        views = attach_arrays(descriptor["layouts"]["neighbours"], writable)
+        attached_matrices[key] = views["indices"], views["weights"]
+    return attached_matrices[key]
+
+
+def release_shared(descriptor):
+    # Frees the memory allocated by share_matrix or share_neighbours. To be called by the process that shared the
+    # arrays, once the workers are done with them
+    if descriptor is None:
+        return
+    for described in descriptor["layouts"].values():
+        attached_matrices.pop(next(iter(described.values()))[1], None)
+        for mode, location, dtype, shape in described.values():
+            if mode == "shm":
+                segment = shared_segments.pop(location)
+                segment.unlink()
+                # Views still alive (e.g. when released at exit) keep the mapping until they are collected, the
+                # name of the segment is removed anyway
+                try:
+                    segment.close()
+                except BufferError:
+                    pass
+    if "directory" in descriptor:
+        shutil.rmtree(descriptor["directory"], ignore_errors=True)
+
+
+def schedule(function, arguments, chunks, number_of_cpu=None):
+    # Runs function once for every chunk on a pool of number_of_cpu workers (one for each core when None).
+    # Every chunk is a dictionary with the keyword arguments specific of that task, while the arguments in common
+    # are handed to each worker just once by the pool initializer. imap_unordered gives a new chunk to a worker as
+    # soon as it is free, so a few heavy chunks do not leave the other cores idle. The results keep chunk order
+    results = [None] * len(chunks)
+    pool = multiprocessing.Pool(number_of_cpu, initializer=init_worker, initargs=(function, arguments))
+    for position, result in pool.imap_unordered(run_chunk, enumerate(chunks)):
+        results[position] = result
+    pool.close()
+    pool.join()
+    return results
+
+
+def init_worker(function, arguments):
+    # Pool initializer: stores the function to run and its common arguments in the worker
+    worker_task["function"] = function
+    worker_task["arguments"] = arguments
+
+
+def run_chunk(numbered_chunk):
+    # Runs the worker function on a single chunk, returning also the position of the chunk
+    position, chunk = numbered_chunk
+    return position, worker_task["function"](**chunk, **worker_task["arguments"])
+
+
+def artifact_key(files, parameters):
+    # Hash identifying an artifact: the version of the input files (path, size and modification time, as in
+    # store_source, without reading them) plus the parameters that would change it
+    digest = hashlib.sha1()
+    for filename in files:
+        if filename is not None:
+            digest.update(json.dumps(store_source(filename), sort_keys=True).encode())
+    digest.update(repr(parameters).encode())
+    return digest.hexdigest()
+
+
+def artifact_path(explicit_path, cache_dir, prefix, key, extension=".npz"):
+    # An explicitly given file wins over the cache directory, no directory means that the artifact is not persisted
+    if explicit_path is not None:
+        return explicit_path
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, prefix + "_" + key + extension)
+
+
+def save_artifact(path, key, matrix, **arrays):
+    # Stores a CSR/CSC matrix, its key and some other arrays in a single (uncompressed) npz file
+    if os.path.dirname(path) != "":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        np.savez(f, key=key, format=matrix.format, shape=matrix.shape, data=matrix.data, indices=matrix.indices,
+                 indptr=matrix.indptr, **arrays)
+
+
+def load_artifact(path, key):
+    # Returns the matrix and the other arrays stored by save_artifact, or None when the file does not exist or
+    # was built from different inputs or parameters. Non numeric ids are stored as object arrays, as in
+    # load_interaction_store they are read with allow_pickle so that they keep their type
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=True) as artifact:
+        if str(artifact["key"]) != key:
+            time_print("Ignoring ", path, ": it was built from different inputs or parameters", style="Info")
+            return None
+        arrays = {name: artifact[name] for name in artifact.files}
+    matrix_class = sps.csr_matrix if str(arrays.pop("format")) == "csr" else sps.csc_matrix
+    matrix = matrix_class((arrays.pop("data"), arrays.pop("indices"), arrays.pop("indptr")),
+                          shape=tuple(arrays.pop("shape")))
+    return matrix, arrays
+
+
+def unpack_urm_artifact(artifact):
+    # Splits a URM artifact in the matrix, the target users, the id indexes and the statistics of the URM
+    user_rating_matrix, arrays = artifact
+    target_users = arrays.pop("target_users")
+    user_index = IdIndex(arrays.pop("users"))
+    item_index = IdIndex(arrays.pop("items"))
+    return user_rating_matrix, target_users, user_index, item_index, arrays
+
+
+def save_neighbours(path, key, neighbour_indices, neighbour_weights):
+    # Stores the neighbours arrays as two .npy files in the path directory, so that they can be memory mapped.
+    # The key is written last: a directory without it is an incomplete artifact
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "indices.npy"), neighbour_indices)
+    np.save(os.path.join(path, "weights.npy"), neighbour_weights)
+    seal_neighbours(path, key)
+
+
+def seal_neighbours(path, key):
+    # Writes the key of a neighbours artifact whose arrays are already in path, making it complete
+    with open(os.path.join(path, "key"), 'w') as f:
+        f.write(key)
+
+
+def load_neighbours(path, key):
+    # Memory maps (read only) the neighbours arrays stored by save_neighbours. None when they are not found or
+    # were built from different inputs or parameters
+    if path is None or not os.path.exists(os.path.join(path, "key")):
+        return None
+    with open(os.path.join(path, "key"), 'r') as f:
+        if f.read() != key:
+            time_print("Ignoring ", path, ": it was built from different inputs or parameters", style="Info")
+            return None
+    return np.load(os.path.join(path, "indices.npy"), mmap_mode='r'), \
+        np.load(os.path.join(path, "weights.npy"), mmap_mode='r')
+
+
+class IdIndex:
+    # Association between the ids and their positions (rows or columns of the URM), in place of the two
+    # dictionaries position -> id and id -> position. The ids are kept in a numpy array, read by position, and in a
+    # pandas Index, hashing them towards their positions: whole arrays are translated at once in both directions
+    def __init__(self, ids):
+        self.ids = np.asarray(ids)
+        self.index = pd.Index(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, ids):
+        # Returns the positions of the given ids, -1 for the unknown ones
+        return self.index.get_indexer(np.asarray(ids))
+
+    def decode(self, positions):
+        # Returns the ids in the given positions
+        return self.ids[positions]
+
+
+class Adjacency:
+    # Read only adjacency lists of the URM: the items rated by a user are a slice of the indices of the CSR layout
+    # (the columns of the row), the users that rated an item a slice of the indices of the CSC layout (the rows of
+    # the column). The slices are numpy views, nothing is copied per interaction. user_rating_matrix is a sparse
+    # matrix or the descriptor of share_matrix, in which case the layouts in shared memory are attached.
+    # It also holds the layouts read by the workers, CSR, CSC and binarized CSR, built once: an Adjacency built by
+    # the parent is sent to each worker only once, in pickle mode, instead of converting the URM for every chunk
+    def __init__(self, user_rating_matrix):
+        if isinstance(user_rating_matrix, dict):
+            self.csr = attach_matrix(user_rating_matrix, "csr")
+            self.csc = attach_matrix(user_rating_matrix, "csc")
+            self.binary = attach_matrix(user_rating_matrix, "binary")
+        else:
+            self.csr = user_rating_matrix.tocsr()
+            self.csc = user_rating_matrix.tocsc()
+            self.binary = binarized(self.csr)
 
-    return data, row_ind, col_ind, new_uid_position_partial, similar_users_id
+    def user_items(self, row):
+        # Returns the columns of the items rated by the user in the given row
+        return read_only(self.csr.indices[self.csr.indptr[row]:self.csr.indptr[row+1]])
 
+    def item_users(self, column):
+        # Returns the rows of the users that rated the item in the given column
+        return read_only(self.csc.indices[self.csc.indptr[column]:self.csc.indptr[column+1]])
 
-def mapper(array, subject="the given input"):
-    # returns a dictionary where each value is associated to position
-    to_return = {}
-    return_to = {}
-    for i in range(len(array)):
-        to_return[array[i]] = i
-    time_print("Completed position-id association for ", subject)
-    for key in to_return.keys():
-        return_to[to_return[key]] = key
-    time_print("Completed id-position association for ", subject)
-    return to_return, return_to
 
+def as_adjacency(user_rating_matrix):
+    # The Adjacency of a URM given as a sparse matrix, a descriptor of share_matrix or an Adjacency already built,
+    # returned as it is
+    if isinstance(user_rating_matrix, Adjacency):
+        return user_rating_matrix
+    return Adjacency(user_rating_matrix)
 
-def data_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id", rating_key="rating"):
+
+def read_only(view):
+    # The same view, flagged as not writable
+    view.flags.writeable = False
+    return view
+
+
+def data_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id", rating_key="rating",
+                     delimiter='\t'):
     # Import the interaction file in a Pandas data frame
     with open(interactions, 'r') as f:
-        interactions_reader = pd.read_csv(interactions, delimiter='\t')
+        interactions_reader = pd.read_csv(interactions, delimiter=delimiter)
 
     # Here the program fills the array with all the users to be recommended
     # after this if/else target_users contains this information
     time_print("Listing the target users", style="Info")
-    interacting_users = interactions_reader[user_key].as_matrix()
+    interacting_users = interactions_reader[user_key].values
     if target_users_file is None:
-        target_users = interacting_users
-        users = interacting_users
+        target_users = pd.unique(interacting_users)
+        users = target_users
     else:
         with open(target_users_file, 'r') as t:
-            target_users_reader = pd.read_csv(target_users_file, delimiter='\t')
-        target_users = target_users_reader[user_key].as_matrix()
+            target_users_reader = pd.read_csv(target_users_file, delimiter=delimiter)
+        target_users = pd.unique(target_users_reader[user_key].values)
         users = list(set(np.hstack((target_users, interacting_users))))
         t.close()
 
-    # Computes the size of the user rating matrix using a simple parallel splitting to increase the speed
+    # Computes the size of the user rating matrix and the id <-> position associations
     time_print("Defining the dimension of the URM and mapping", style="Info")
-    items = list(set(interactions_reader[item_key].as_matrix()))
-    pool = multiprocessing.Pool()
-    position_iid_dic_process = pool.apply_async(mapper, (items, "Items",))
-    iid_position_dic, position_iid_dic = position_iid_dic_process.get()
-    position_uid_dic_process = pool.apply_async(mapper, (users, "Users",))
-    uid_position_dic, position_uid_dic = position_uid_dic_process.get()
-
-    pool.close()
-    pool.terminate()
+    items = list(set(interactions_reader[item_key].values))
+    user_index = IdIndex(users)
+    item_index = IdIndex(items)
 
     row_number = len(users)
     col_number = len(items)
@@ -282,196 +838,800 @@ def data_importation(interactions, target_users_file=None, user_key="user_id", i
     # of the user u_id with the item i_id. The rating assigned to each user to an item is equal to the number
     # of interactions that he had with the item
     time_print("Building the temporary dictionary of interactions", style="Info")
-    for i, row in interactions_reader.iterrows():
-        key = (uid_position_dic[row[user_key]], iid_position_dic[row[item_key]])
+    user_positions = user_index.encode(interactions_reader[user_key].values).tolist()
+    item_positions = item_index.encode(interactions_reader[item_key].values).tolist()
+    for key, rating in zip(zip(user_positions, item_positions), interactions_reader[rating_key].values):
         if key in temp_dic.keys():
-            temp_dic[key] += row[rating_key]
+            temp_dic[key] += rating
         else:
-            temp_dic[key] = row[rating_key]
+            temp_dic[key] = rating
     f.close()
     print('FILECHIUSOOOOOOOOOOOOOOOOOO')
-    return temp_dic, row_number, col_number, target_users, users, position_uid_dic, \
-        uid_position_dic, position_iid_dic, iid_position_dic
+    return temp_dic, row_number, col_number, target_users, user_index, item_index
 
 
-def urm_computer(interactions, target_users_file=None, user_key="user_id", item_key="item_id", rating_key="rating",
-                 _user_bias_=1, _item_bias_=1):
-    # This functions returns the couple, users to recommend and user rating matrix
+def columnar_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                         rating_key="rating", delimiter='\t'):
+    # Same contract of data_importation, but instead of the tuple indexed dictionary it returns the interactions
+    # as three aligned COO arrays (rows, cols, values). The ids are factorized into integer codes and the duplicated
+    # (user, item) couples are aggregated with array operations, so no Python object is created per interaction
+    interactions_reader = pd.read_csv(interactions, delimiter=delimiter, usecols=[user_key, item_key, rating_key])
 
-    (temp_dic, row_number, col_number, target_users, users,
-     position_uid_dic, uid_position_dic, position_iid_dic, iid_position_dic) = \
-        data_importation(interactions, target_users_file, user_key, item_key, rating_key)
+    time_print("Listing the target users", style="Info")
+    interacting_users = interactions_reader[user_key].values
+    if target_users_file is None:
+        target_users = pd.unique(interacting_users)
+    else:
+        target_users = pd.unique(pd.read_csv(target_users_file, delimiter=delimiter)[user_key].values)
 
-    # Converting dictionary values into integers and subtracting the user bias
-    time_print("Computing the user bias for each user", style="Info")
+    # The codes returned by the factorization are directly the positions in the URM. Target users come first so
+    # that the ones without interactions get a row as well
+    time_print("Factorizing the user and item ids", style="Info")
+    user_codes, users = pd.factorize(np.hstack((target_users, interacting_users)))
+    row_ind = user_codes[len(target_users):]
+    col_ind, items = pd.factorize(interactions_reader[item_key].values)
+    ratings = interactions_reader[rating_key].values
+    del interactions_reader
 
-    # For each line summing all the votes, and counting the number
-    totals = {}
-    row_elements = {}
+    row_number = len(users)
+    col_number = len(items)
+
+    return aggregate_interactions(row_ind, col_ind, ratings, row_number, col_number), row_number, col_number, \
+        target_users, IdIndex(users), IdIndex(items)
 
-    for key in temp_dic.keys():
-        value = int(temp_dic[key])
-        if key[0] in totals.keys():
-            totals[key[0]] += value
-            row_elements[key[0]] += 1
-        else:
-            totals[key[0]] = value
-            row_elements[key[0]] = 1
-
-    # Computing the bias of each user
-    user_average = {}
-    for key in temp_dic.keys():
-        user_average[key[0]] = totals[key[0]]/row_elements[key[0]]
-
-    # For each column summing all the votes and counting the number
-    time_print("Computing the item bias for each item", style="Info")
-    totals.clear()
-    col_elements = {}
-
-    for key in temp_dic.keys():
-        value = int(temp_dic[key]) - user_average[key[0]]*_user_bias_
-        if key[1] in totals.keys():
-            totals[key[1]] += value
-            col_elements[key[1]] += 1
-        else:
-            totals[key[1]] = value
-            col_elements[key[1]] = 1
 
-    # Computing the bias of each item
-    item_average = {}
-    for key in temp_dic.keys():
-        item_average[key[1]] = totals[key[1]] / col_elements[key[1]]
+def parallel_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                         rating_key="rating", delimiter='\t', number_of_cpu=None):
+    # Same contract of columnar_importation, with the file parsed in parallel. The file is split in byte ranges
+    # aligned to the line ends, each one parsed by a worker of the scheduler into its local codes and ids. The local
+    # ids are then factorized together in file order, so the positions are the same of columnar_importation
+    with open(interactions, 'rb') as f:
+        header = f.readline()
+        ranges = byte_ranges(f, len(header), os.path.getsize(interactions),
+                             PARSING_RANGES_PER_CPU * (number_of_cpu or os.cpu_count()))
+    names = header.decode().rstrip('\r\n').split(delimiter)
 
-    # Conversion and subtraction of the bias if requested
-    data = []
+    time_print("Parsing ", str(len(ranges)), " byte ranges of ", interactions, style="Info")
+    chunks = [{"start": start, "end": end} for start, end in ranges]
+    results = schedule(parse_range, {"interactions": interactions, "names": names,
+                                     "usecols": [user_key, item_key, rating_key], "delimiter": delimiter},
+                       chunks, number_of_cpu)
+
+    time_print("Listing the target users", style="Info")
+    range_users = [result[1] for result in results]
+    if target_users_file is None:
+        target_users = pd.unique(np.hstack([np.zeros(0, dtype=np.int64)] + range_users))
+    else:
+        target_users = pd.unique(pd.read_csv(target_users_file, delimiter=delimiter)[user_key].values)
+
+    # The local ids of every range are translated in global positions: the local codes are then positions in the
+    # arrays of the translations
+    time_print("Factorizing the user and item ids", style="Info")
+    user_codes, users = pd.factorize(np.hstack([target_users] + range_users))
+    item_codes, items = pd.factorize(np.hstack([np.zeros(0, dtype=np.int64)] + [result[3] for result in results]))
     row_ind = []
     col_ind = []
+    user_offset = len(target_users)
+    item_offset = 0
+    for local_users, users_of_range, local_items, items_of_range, ratings in results:
+        row_ind.append(user_codes[user_offset:user_offset+len(users_of_range)][local_users])
+        col_ind.append(item_codes[item_offset:item_offset+len(items_of_range)][local_items])
+        user_offset += len(users_of_range)
+        item_offset += len(items_of_range)
+    ratings = np.hstack([np.zeros(0)] + [result[4] for result in results])
+    del results
+
+    row_number = len(users)
+    col_number = len(items)
+    return aggregate_interactions(np.hstack([np.zeros(0, dtype=np.int64)] + row_ind),
+                                  np.hstack([np.zeros(0, dtype=np.int64)] + col_ind), ratings, row_number,
+                                  col_number), row_number, col_number, target_users, IdIndex(users), IdIndex(items)
+
+
+def byte_ranges(f, start, size, parts):
+    # Splits the bytes from start to size of the open file f in at most parts ranges, moving each boundary to the
+    # beginning of the following line. Returns the list of (start, end) couples
+    boundaries = [start]
+    for part in range(1, parts):
+        boundary = start + (size - start) * part // parts
+        if boundary <= boundaries[-1]:
+            continue
+        # The line containing the byte before the boundary is completed: if that byte is a line end the boundary
+        # is already the beginning of a line
+        f.seek(boundary - 1)
+        f.readline()
+        if f.tell() < size and f.tell() > boundaries[-1]:
+            boundaries.append(f.tell())
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i+1]) for i in range(len(boundaries) - 1) if boundaries[i+1] > boundaries[i]]
+
+
+def parse_range(interactions, start, end, names, usecols, delimiter='\t'):
+    # Parses the lines between the bytes start and end of the interactions file. Returns the local codes and ids of
+    # users and items, in order of first appearance in the range, and the ratings
+    with open(interactions, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    reader = pd.read_csv(io.BytesIO(data), delimiter=delimiter, header=None, names=names, usecols=usecols)
+    del data
+    user_codes, users = pd.factorize(reader[usecols[0]].values)
+    item_codes, items = pd.factorize(reader[usecols[1]].values)
+    return user_codes, users, item_codes, items, reader[usecols[2]].values.astype(np.float64)
+
+
+def binary_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                       rating_key="rating", delimiter='\t', memory_budget=1024, interaction_store=None,
+                       time_key="created_at"):
+    # Same contract of columnar_importation, reading the interactions from their binary columnar store instead of
+    # parsing the text file. The store is built from the text file the first time, or when the file changes
+    if interaction_store is None:
+        interaction_store = os.path.splitext(interactions)[0] + ".store"
+    store = load_interaction_store(interaction_store, interactions, user_key, item_key, rating_key, time_key)
+    if store is None:
+        time_print("Converting ", interactions, " in the binary store ", interaction_store)
+        save_interaction_store(interaction_store, interactions, user_key, item_key, rating_key, time_key, delimiter,
+                               memory_budget)
+        store = load_interaction_store(interaction_store, interactions, user_key, item_key, rating_key, time_key)
+    header, columns, users, items = store
+    time_print("Memory mapped ", str(header["rows"]), " interactions from ", interaction_store, style="Info")
+
+    # The users of the store are in order of first appearance, as the interacting users of columnar_importation:
+    # factorizing them after the target users gives the same positions
+    if target_users_file is None:
+        target_users = users
+    else:
+        target_users = pd.unique(pd.read_csv(target_users_file, delimiter=delimiter)[user_key].values)
+    user_codes, users = pd.factorize(np.hstack((target_users, users)))
+    row_ind = user_codes[len(target_users):][columns["user"]]
+
+    return aggregate_interactions(row_ind, columns["item"], columns["rating"], len(users), len(items)), \
+        len(users), len(items), target_users, IdIndex(users), IdIndex(items)
+
+
+def save_interaction_store(path, interactions, user_key="user_id", item_key="item_id", rating_key="rating",
+                           time_key="created_at", delimiter='\t', memory_budget=1024):
+    # Converts the interactions file in a binary columnar store: a directory with a raw file for each column (the
+    # users and items as codes, the ratings and, when the file has them, the timestamps), the ids corresponding to the
+    # codes in users.npy and items.npy, in order of first appearance, and a header.json describing them. The file is
+    # read in chunks as in streaming_importation, the header is written last: without it the store is incomplete
+    os.makedirs(path, exist_ok=True)
+    keys = {"user": user_key, "item": item_key, "rating": rating_key}
+    if time_key in pd.read_csv(interactions, delimiter=delimiter, nrows=0).columns:
+        keys["time"] = time_key
+    if os.path.exists(os.path.join(path, "header.json")):
+        os.remove(os.path.join(path, "header.json"))
+
+    users = None
+    items = None
+    rows = 0
+    chunk_rows = max(int(memory_budget * 2**20 // STREAMING_BYTES_PER_ROW), 1)
+    files = {column: open(os.path.join(path, column + ".bin"), 'wb') for column in keys}
+    for chunk in pd.read_csv(interactions, delimiter=delimiter, usecols=list(keys.values()), chunksize=chunk_rows):
+        users, codes = grow_index(users, chunk[user_key].values)
+        files["user"].write(codes.astype(STORE_DTYPES["user"]).tobytes())
+        items, codes = grow_index(items, chunk[item_key].values)
+        files["item"].write(codes.astype(STORE_DTYPES["item"]).tobytes())
+        for column in keys.keys() - {"user", "item"}:
+            files[column].write(chunk[keys[column]].values.astype(STORE_DTYPES[column]).tobytes())
+        rows += len(chunk)
+    for f in files.values():
+        f.close()
+
+    np.save(os.path.join(path, "users.npy"), users.values if users is not None else np.zeros(0, dtype=np.int64))
+    np.save(os.path.join(path, "items.npy"), items.values if items is not None else np.zeros(0, dtype=np.int64))
+    with open(os.path.join(path, "header.json"), 'w') as f:
+        json.dump({"source": store_source(interactions), "keys": keys, "rows": rows,
+                   "columns": {column: STORE_DTYPES[column] for column in keys}}, f)
+
+
+def load_interaction_store(path, interactions=None, user_key="user_id", item_key="item_id", rating_key="rating",
+                           time_key="created_at"):
+    # Opens the store written by save_interaction_store without parsing anything: returns its header, the columns
+    # memory mapped (read only) by name and the ids of users and items. None when the store is missing, incomplete,
+    # built with other keys or from a different version of the interactions file
+    if path is None or not os.path.exists(os.path.join(path, "header.json")):
+        return None
+    with open(os.path.join(path, "header.json"), 'r') as f:
+        header = json.load(f)
+    keys = header["keys"]
+    if [keys["user"], keys["item"], keys["rating"]] != [user_key, item_key, rating_key] or \
+            keys.get("time", time_key) != time_key or \
+            (interactions is not None and header["source"] != store_source(interactions)):
+        time_print("Ignoring ", path, ": it was built from different inputs or keys", style="Info")
+        return None
+    columns = {}
+    for column, dtype in header["columns"].items():
+        if header["rows"] == 0:
+            columns[column] = np.zeros(0, dtype=dtype)
+        else:
+            columns[column] = np.memmap(os.path.join(path, column + ".bin"), dtype=dtype, mode='r',
+                                        shape=(header["rows"],))
+    return header, columns, np.load(os.path.join(path, "users.npy"), allow_pickle=True), \
+        np.load(os.path.join(path, "items.npy"), allow_pickle=True)
+
+
+def store_source(interactions):
+    # Identifies the version of the interactions file a store was built from, without reading it
+    status = os.stat(interactions)
+    return {"file": os.path.abspath(interactions), "size": status.st_size, "mtime_ns": status.st_mtime_ns}
+
+
+def aggregate_interactions(row_ind, col_ind, ratings, row_number, col_number):
+    # Sums the ratings of the duplicated (row, col) couples, returning the COO arrays (rows, cols, values). Each
+    # couple is encoded as a single linear index, the duplicates are then summed with a bincount over the unique
+    # linear indices. The result is sorted row-wise, as a CSR matrix would be
+    time_print("Aggregating the duplicated interactions", style="Info")
+    linear_ind = np.asarray(row_ind, dtype=np.int64) * col_number + col_ind
+    linear_ind, inverse = np.unique(linear_ind, return_inverse=True)
+    data = np.bincount(inverse.ravel(), weights=ratings, minlength=len(linear_ind))
+    return (linear_ind // col_number).astype(INDEX_DTYPE), (linear_ind % col_number).astype(INDEX_DTYPE), data
+
+
+def streaming_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                          rating_key="rating", delimiter='\t', memory_budget=1024):
+    # Same contract of columnar_importation, but the interactions file is read in chunks, each one folded in the
+    # running aggregates: the (user, item) couples met so far with the sum of their ratings. The chunks are sized
+    # so that reading and aggregating one of them fits in memory_budget MB: the memory used does not depend on the
+    # size of the file, but only on the number of distinct couples, i.e. on the size of the URM itself
+    chunk_rows = max(int(memory_budget * 2**20 // STREAMING_BYTES_PER_ROW), 1)
+
+    # As in columnar_importation target users come first, then the users and items in order of appearance
+    users = None
+    target_users = None
+    if target_users_file is not None:
+        target_users = pd.unique(pd.read_csv(target_users_file, delimiter=delimiter)[user_key].values)
+        users = pd.Index(target_users)
+    items = None
+
+    # Aggregated chunks not merged yet in the running aggregates. They are merged when they get as big as the running
+    # aggregates, so every couple is merged a logarithmic number of times
+    keys = np.zeros(0, dtype=np.int64)
+    sums = np.zeros(0)
+    pending = []
+    pending_size = 0
+    time_print("Reading the interactions in chunks of ", str(chunk_rows), " rows", style="Info")
+    for chunk in pd.read_csv(interactions, delimiter=delimiter, usecols=[user_key, item_key, rating_key],
+                             chunksize=chunk_rows):
+        users, row_ind = grow_index(users, chunk[user_key].values)
+        items, col_ind = grow_index(items, chunk[item_key].values)
+        # Row and column are packed in a single key, sorting the keys sorts the couples row-wise
+        chunk_keys, inverse = np.unique((row_ind.astype(np.int64) << 32) | col_ind, return_inverse=True)
+        pending.append((chunk_keys, np.bincount(inverse.ravel(), weights=chunk[rating_key].values,
+                                                minlength=len(chunk_keys))))
+        pending_size += len(chunk_keys)
+        del chunk, row_ind, col_ind, inverse
+        if pending_size >= max(len(keys), chunk_rows):
+            keys, sums = merge_aggregates([(keys, sums)] + pending)
+            pending = []
+            pending_size = 0
+    keys, sums = merge_aggregates([(keys, sums)] + pending)
+
+    if users is None:
+        users = pd.Index(np.zeros(0, dtype=np.int64))
+    if items is None:
+        items = pd.Index(np.zeros(0, dtype=np.int64))
+    if target_users is None:
+        target_users = users.values
+    time_print("Read ", str(len(keys)), " distinct interactions", style="Info")
+
+    return ((keys >> 32).astype(INDEX_DTYPE), (keys & 0xFFFFFFFF).astype(INDEX_DTYPE), sums), len(users), \
+        len(items), target_users, IdIndex(users.values), IdIndex(items.values)
+
+
+def grow_index(index, ids):
+    # Returns the positions of ids in a pandas Index, along with the Index extended with the ids never met before,
+    # appended in order of first appearance
+    if index is None:
+        codes, uniques = pd.factorize(ids)
+        return pd.Index(uniques), codes
+    codes = index.get_indexer(ids)
+    unseen = codes < 0
+    if unseen.any():
+        new_codes, new_ids = pd.factorize(ids[unseen])
+        codes[unseen] = new_codes + len(index)
+        index = index.append(pd.Index(new_ids))
+    return index, codes
+
+
+def merge_aggregates(aggregates):
+    # Merges a list of (keys, sums) couples, summing the sums of the same key. The keys of the result are sorted
+    keys = np.concatenate([aggregate[0] for aggregate in aggregates])
+    sums = np.concatenate([aggregate[1] for aggregate in aggregates])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=sums, minlength=len(keys))
+
+
+def interactions_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                             rating_key="rating", ingestion_mode="dict", delimiter='\t', memory_budget=1024,
+                             interaction_store=None, time_key="created_at", number_of_cpu=None):
+    # Reads the interactions with the requested ingestion mode. Whatever the mode, they are returned as three
+    # aligned COO arrays (rows, cols, values) with one element for each (user, item) couple, followed by the size of
+    # the URM, the target users and the id indexes of users and items
+    if ingestion_mode == "columnar":
+        return columnar_importation(interactions, target_users_file, user_key, item_key, rating_key, delimiter)
+    if ingestion_mode == "streaming":
+        return streaming_importation(interactions, target_users_file, user_key, item_key, rating_key, delimiter,
+                                     memory_budget)
+    if ingestion_mode == "binary":
+        return binary_importation(interactions, target_users_file, user_key, item_key, rating_key, delimiter,
+                                  memory_budget, interaction_store, time_key)
+    if ingestion_mode == "parallel":
+        return parallel_importation(interactions, target_users_file, user_key, item_key, rating_key, delimiter,
+                                    number_of_cpu)
+
+    temp_dic, row_number, col_number, target_users, user_index, item_index = \
+        data_importation(interactions, target_users_file, user_key, item_key, rating_key, delimiter)
+    # The dictionary of interactions is converted in the COO arrays
+    keys = np.array(list(temp_dic.keys()), dtype=INDEX_DTYPE).reshape(-1, 2)
+    values = np.fromiter(temp_dic.values(), dtype=np.float64, count=len(temp_dic))
+    return (keys[:, 0], keys[:, 1], values), row_number, col_number, target_users, user_index, item_index
 
-    # user rated items is a dictionary in which to every user_id is associated the list of the items (indicated by
-    # column number) that he rated
-    user_rated_items = {}
-    item_rating_users = {}
-    time_print("Converting values to the right format and subtracting the user bias...", style="Info")
-    for key in temp_dic.keys():
-        value = int(temp_dic[key])
-        data.append(value-user_average[key[0]]*_user_bias_-item_average[key[1]]*_item_bias_)
-        row_ind.append(int(key[0]))
-        col_ind.append(int(key[1]))
-        key_user = position_uid_dic[key[0]]
-        if key_user not in user_rated_items.keys():
-            user_rated_items[key_user] = []
-        if key[1] not in item_rating_users.keys():
-            item_rating_users[key[1]] = []
-        item_rating_users[key[1]].append((int(key[0])))
-        user_rated_items[key_user].append((int(key[1])))
-
-    tot = 0
-    c = 0
-    zeros = 0
-    interactive_targets = 0
-    for key in user_rated_items.keys():
-        tot += len(user_rated_items[key])
-        c += 1
-        if key in target_users:
-            interactive_targets += 1
-        if len(user_rated_items[key]) == 0 and key in target_users:
-            zeros += 1
-
-    zeros += len(target_users)-interactive_targets
-    time_print("in average every user evaluated ", str(tot/c)+" ", " items and ", str(zeros) +
-               " of the target users evaluated no items", style="Info")
-
-    # Create a sparse matrix from the interactions
-    time_print("Creating the sparse matrix with the data", style="Info")
-    user_rating_matrix = sps.csc_matrix((data, (row_ind, col_ind)), shape=(row_number, col_number))
 
-    #data.clear()
-    #row_ind.clear()
-    #col_ind.clear()
+def urm_computer(interactions, target_users_file=None, user_key="user_id", item_key="item_id", rating_key="rating",
+                 _user_bias_=1, _item_bias_=1, ingestion_mode="dict", user_damping=0, item_damping=0, delimiter='\t',
+                 memory_budget=1024, interaction_store=None, time_key="created_at", number_of_cpu=None,
+                 precision="float32"):
+    # This functions returns the couple, users to recommend and user rating matrix
+    coo_arrays, row_number, col_number, target_users, user_index, item_index = \
+        interactions_importation(interactions, target_users_file, user_key, item_key, rating_key, ingestion_mode,
+                                 delimiter, memory_budget, interaction_store, time_key, number_of_cpu)
+    user_rating_matrix = \
+        urm_builder(coo_arrays, row_number, col_number, target_users, user_index, _user_bias_, _item_bias_,
+                    user_damping, item_damping, precision)
 
     # returns the non-normalized User Rating Matrix
-    return user_rating_matrix, target_users, users, position_uid_dic, uid_position_dic, position_iid_dic,\
-        iid_position_dic, row_number, col_number, user_rated_items, item_rating_users
-
-
-def recommend(similarity_matrix, user_rating_matrix, target_users, new_uid_position,
-              position_iid_dic, position_uid_dic, user_rated_items, rec_length, expired_items,
-              name="Generic Rec-Sys", item_rating_user=None):
-    # This function takes a sparse similarity matrix, a list of users and the number of desired recommendations
-    # and returns a dictionary u_id -> {rec_items_id}
-    counter = 0
-    non_profiled_users = []
-    # variable to count the users for which is not possible to provide user based recommendations
-    non_profiled_users_number = 0
-
-    # To each key (user_id) is associated a tuple composed by : (item_id,est_rating)
-    rec_dictionary = dict()
-    rating_user_matrix = user_rating_matrix.transpose(copy=True)
-    # For every user in target_users you have to compute
-    for user in target_users:
-        # The row of the similarity matrix corresponding to our user
-        sim_sparse_row = similarity_matrix.getrow(new_uid_position[user])
-        similarity_matrix_row = sim_sparse_row.todense().tolist()[0]
+    # along with the statistics needed to update it with a delta file
+    urm_state = urm_statistics(coo_arrays, row_number, col_number, _user_bias_, user_damping)
+    return user_rating_matrix, target_users, user_index, item_index, row_number, col_number, urm_state
 
-        # For every target user we have to compute the similarity for all the interesting items
-        # where interesting means that have been evaluated at least by one of the neighbours
 
-        # Building the interesting_item_list by merging the respective lines in the user rated items list
-        interesting_items = []
-        neighbours_columns = sim_sparse_row.nonzero()[1]
-        for column in neighbours_columns:
-            interesting_items.extend(user_rated_items[position_uid_dic[column]])
-        interesting_items = list(set(interesting_items))
-        recommendable_items = len(interesting_items)
+def urm_builder(coo_arrays, row_number, col_number, target_users, user_index, _user_bias_=1, _item_bias_=1,
+                user_damping=0, item_damping=0, precision="float32"):
+    # Builds the URM (CSC) from the COO arrays returned by interactions_importation. The biases are computed in
+    # float64, the values of the URM are then stored with the given precision
+    row_ind, col_ind, values = coo_arrays
+
+    # The biases are computed on the sparse matrix of the raw ratings and subtracted from its elements
+    time_print("Computing the user and item biases", style="Info")
+    user_rating_matrix = sps.coo_matrix((values, (row_ind, col_ind)), shape=(row_number, col_number))
+    user_rating_matrix, user_average, item_average = remove_biases(user_rating_matrix, _user_bias_, _item_bias_,
+                                                                   user_damping, item_damping)
+
+    time_print("Creating the sparse matrix with the data", style="Info")
+    user_rating_matrix.data = user_rating_matrix.data.astype(precision)
+    user_rating_matrix = user_rating_matrix.tocsc()
+
+    # user rated items is a dictionary in which to every user_id is associated the list of the items (indicated by
+    # column number) that he rated
+    # The statistics are read from two boolean masks over the rows: the users with some interaction and the targets
+    interacting = user_rating_matrix.getnnz(axis=1) > 0
+    targets = target_rows(user_index, target_users)
+    time_print("in average every user evaluated ", str(len(values)/max(np.count_nonzero(interacting), 1))+" ",
+               " items and ", str(np.count_nonzero(targets & ~interacting)) + " of the target users evaluated no items",
+               style="Info")
+    time_print(str(np.count_nonzero(interacting & ~targets)), " interacting users are not targets", style="Info")
+
+    return user_rating_matrix
+
+
+def l2_normalize(matrix):
+    # Row-wise L2 normalization of a sparse matrix, returned in CSR format (in place when it is already CSR). Rows
+    # without elements are left as they are. As in sklearn.preprocessing.normalize the squares are summed in double
+    # precision in the order of the elements, so that the normalized values are the same
+    matrix = matrix.tocsr()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    norms = np.sqrt(np.bincount(rows, weights=matrix.data * matrix.data, minlength=matrix.shape[0]))
+    norms[norms == 0] = 1
+    np.divide(matrix.data, norms[rows], out=matrix.data, casting="unsafe")
+    return matrix
+
+
+def remove_biases(user_rating_matrix, _user_bias_=1, _item_bias_=1, user_damping=0, item_damping=0):
+    # Subtracts the user and item biases from the elements of a COO matrix without duplicates, returning the new
+    # matrix and the two arrays of biases. The user bias is the average of the row, the item bias the average of the
+    # column once the user bias is removed: both are row/column sums over nnz counts, read in a single pass on the
+    # COO arrays. The damping terms shrink the averages of the rows (towards the global average) and of the columns
+    # (towards zero) with few elements, a damping of 0 gives the plain averages
+    rows, cols, values = user_rating_matrix.row, user_rating_matrix.col, user_rating_matrix.data
+    row_number, col_number = user_rating_matrix.shape
+    global_average = values.mean() if len(values) > 0 else 0
+
+    # Rows and columns without any element get a zero bias
+    row_elements = np.bincount(rows, minlength=row_number) + user_damping
+    user_average = np.divide(np.bincount(rows, weights=values, minlength=row_number) + user_damping*global_average,
+                             row_elements, out=np.zeros(row_number), where=row_elements > 0) * _user_bias_
+    values = values - user_average[rows]
+
+    col_elements = np.bincount(cols, minlength=col_number) + item_damping
+    item_average = np.divide(np.bincount(cols, weights=values, minlength=col_number), col_elements,
+                             out=np.zeros(col_number), where=col_elements > 0) * _item_bias_
+    values -= item_average[cols]
+
+    return sps.coo_matrix((values, (rows, cols)), shape=(row_number, col_number)), user_average, item_average
+
+
+def urm_statistics(coo_arrays, row_number, col_number, _user_bias_=1, user_damping=0):
+    # Sufficient statistics of the URM, stored with it so that urm_update can merge a delta file without reading
+    # the whole history again: the raw ratings in the (sorted) CSR order of the URM, the sum and the number of the
+    # ratings of every row and of all of them, the sum of the ratings of every column once the user bias is removed
+    # and their number
+    row_ind, col_ind, values = coo_arrays
+    raw = sps.csr_matrix((values, (row_ind, col_ind)), shape=(row_number, col_number))
+    raw.sort_indices()
+    rows = np.repeat(np.arange(row_number), np.diff(raw.indptr))
+    statistics = {"raw": raw.data, "user_sums": np.bincount(rows, weights=raw.data, minlength=row_number),
+                  "user_counts": np.bincount(rows, minlength=row_number), "global_sum": raw.data.sum(),
+                  "global_count": len(raw.data)}
+    user_average = bias_averages(statistics, "user", _user_bias_, user_damping)
+    statistics["item_sums"] = np.bincount(raw.indices, weights=raw.data - user_average[rows], minlength=col_number)
+    statistics["item_counts"] = np.bincount(raw.indices, minlength=col_number)
+    return statistics
+
+
+def bias_averages(statistics, kind, bias=1, damping=0):
+    # The user ("user") or item ("item") biases given by the statistics of urm_statistics, as computed by
+    # remove_biases
+    sums = statistics[kind + "_sums"]
+    elements = statistics[kind + "_counts"] + damping
+    if kind == "user":
+        global_average = statistics["global_sum"] / statistics["global_count"] if statistics["global_count"] > 0 \
+            else 0
+        sums = sums + damping*global_average
+    return np.divide(sums, elements, out=np.zeros(len(sums)), where=elements > 0) * bias
+
+
+def urm_update(user_rating_matrix, statistics, target_users, user_index, item_index, delta_file,
+               all_users_targets=False, user_key="user_id", item_key="item_id", rating_key="rating", _user_bias_=1,
+               _item_bias_=1, user_damping=0, item_damping=0, delimiter='\t', normalize_rows=True,
+               precision="float32"):
+    # Merges the interactions of delta_file in a URM built by urm_builder (normalized or not) and its statistics,
+    # returning the updated URM (CSR), target users, id indexes and statistics. The new users and items are
+    # appended to the id indexes, the new (user, item) couples are inserted in the matrix and the ratings of the
+    # existing ones are summed. The saving over a full rebuild is that the history is not read and aggregated
+    # again: the update still does O(nnz) work on every call (CSR conversion, keys and insertions over arrays as
+    # long as the URM) and the nearest neighbours are then recomputed as usual. Only the rows with a changed
+    # element are given new values and normalized again, but in practice they are nearly all of them: every row
+    # holding an item whose bias changed is dirty, and with user_damping > 0 the global average moves the bias of
+    # every user. When all the users are targets (no target users file) the new users become targets too
+    time_print("Reading the delta interactions", style="Info")
+    delta = pd.read_csv(delta_file, delimiter=delimiter, usecols=[user_key, item_key, rating_key])
+    users, delta_rows = grow_index(user_index.index, delta[user_key].values)
+    items, delta_cols = grow_index(item_index.index, delta[item_key].values)
+    old_row_number, old_col_number = user_rating_matrix.shape
+    row_number, col_number = len(users), len(items)
+    delta_rows, delta_cols, delta_values = aggregate_interactions(delta_rows, delta_cols, delta[rating_key].values,
+                                                                  row_number, col_number)
+    del delta
+
+    # Every element is identified by its row and column packed in a single key, sorted as in the CSR order. The
+    # delta couples are looked for among the ones of the URM with a binary search
+    csr_urm = user_rating_matrix.tocsr()
+    csr_urm.sort_indices()
+    keys = (np.repeat(np.arange(old_row_number, dtype=np.int64), np.diff(csr_urm.indptr)) << 32) | csr_urm.indices
+    delta_keys = (delta_rows.astype(np.int64) << 32) | delta_cols
+    positions = np.searchsorted(keys, delta_keys)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == delta_keys[found]
+    new_couples = ~found
+    time_print(str(len(delta_keys)), " couples in the delta, ", str(np.count_nonzero(new_couples)), " of them new",
+               style="Info")
 
+    # The biases of all the users are recomputed from their statistics, since with damping they depend on the global
+    # average, but only the rows of the users whose bias changed, or with a delta couple, are read from now on
+    old_user_average = grow(bias_averages(statistics, "user", _user_bias_, user_damping), row_number)
+    old_item_average = grow(bias_averages(statistics, "item", _item_bias_, item_damping), col_number)
+    statistics = {"user_sums": grow(statistics["user_sums"], row_number) +
+                  np.bincount(delta_rows, weights=delta_values, minlength=row_number),
+                  "user_counts": grow(statistics["user_counts"], row_number) +
+                  np.bincount(delta_rows[new_couples], minlength=row_number),
+                  "global_sum": statistics["global_sum"] + delta_values.sum(),
+                  "global_count": statistics["global_count"] + np.count_nonzero(new_couples),
+                  "item_sums": grow(statistics["item_sums"], col_number),
+                  "item_counts": grow(statistics["item_counts"], col_number) +
+                  np.bincount(delta_cols[new_couples], minlength=col_number),
+                  "raw": statistics["raw"]}
+    user_average = bias_averages(statistics, "user", _user_bias_, user_damping)
+    changed_users = np.union1d(np.flatnonzero(user_average != old_user_average), delta_rows)
+
+    # The new couples are inserted keeping the CSR order, with a zero raw rating, then the delta ratings are summed
+    # to the raw ones
+    insertions = positions[new_couples]
+    keys = np.insert(keys, insertions, delta_keys[new_couples])
+    inserted = np.insert(np.zeros(len(csr_urm.data), dtype=bool), insertions, True)
+    old_raw = np.insert(statistics["raw"], insertions, 0)
+    raw = old_raw.copy()
+    raw[np.searchsorted(keys, delta_keys)] += delta_values
+    statistics["raw"] = raw
+    data = np.insert(csr_urm.data.astype(precision), insertions, 0)
+    rows = (keys >> 32).astype(INDEX_DTYPE)
+    cols = (keys & 0xFFFFFFFF).astype(INDEX_DTYPE)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=row_number))))
+    del keys
+
+    # The item biases change only through the elements of the changed users, whose contribution to the column sums
+    # is replaced by the new one
+    elements = row_positions(indptr, changed_users)
+    old_contribution = np.where(inserted[elements], 0, old_raw[elements] - old_user_average[rows[elements]])
+    new_contribution = raw[elements] - user_average[rows[elements]]
+    statistics["item_sums"] += np.bincount(cols[elements], weights=new_contribution - old_contribution,
+                                           minlength=col_number)
+    item_average = bias_averages(statistics, "item", _item_bias_, item_damping)
+    changed_items = item_average != old_item_average
+    del old_raw, inserted, elements, old_contribution, new_contribution
+
+    # The elements of the changed users and items get their new values, and their rows are normalized again
+    dirty_rows = np.union1d(changed_users, rows[changed_items[cols]])
+    elements = row_positions(indptr, dirty_rows)
+    values = raw[elements] - user_average[rows[elements]] - item_average[cols[elements]]
+    if normalize_rows:
+        # The rows with a zero norm are left as they are, as normalize does
+        local_rows = np.repeat(np.arange(len(dirty_rows)), indptr[dirty_rows + 1] - indptr[dirty_rows])
+        norms = np.sqrt(np.bincount(local_rows, weights=values**2, minlength=len(dirty_rows)))
+        norms[norms == 0] = 1
+        values /= norms[local_rows]
+    data[elements] = values
+    time_print(str(len(changed_users)), " users and ", str(np.count_nonzero(changed_items)), " items changed, ",
+               str(len(dirty_rows)), " rows updated", style="Info")
+
+    if all_users_targets:
+        target_users = users.values
+    return sps.csr_matrix((data, cols, indptr), shape=(row_number, col_number)), target_users, \
+        IdIndex(users.values), IdIndex(items.values), statistics
+
+
+def grow(array, length):
+    # The array extended with zeros up to length elements
+    return np.concatenate((array, np.zeros(length - len(array), dtype=array.dtype)))
+
+
+def row_positions(indptr, rows):
+    # Positions, in the data of a CSR matrix, of the elements of the given rows, one row after the other
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def recommend(neighbours, user_rating_matrix, target_users, target_index, user_index, item_index, rec_length,
+              expired_columns, popularity, name="Generic Rec-Sys", block_size=1000):
+    # This function takes the nearest neighbours arrays, a list of users and the number of desired recommendations
+    # and returns a dictionary u_id -> [(rec_item_id, est_rating)], built from the arrays of recommend_arrays
+    columns, scores, non_profiled = recommend_arrays(neighbours, user_rating_matrix, target_users, target_index,
+                                                     user_index, rec_length, expired_columns, popularity, name,
+                                                     block_size)
+    rec_dictionary = dict(zip(target_users, recommendation_lists(recommended_items(columns, item_index), scores)))
+    return rec_dictionary, list(np.asarray(target_users)[non_profiled])
+
+
+def recommend_arrays(neighbours, user_rating_matrix, target_users, target_index, user_index, rec_length,
+                     expired_columns, popularity, name="Generic Rec-Sys", block_size=1000):
+    # Estimates the rating of the candidate items one item at a time and returns the recommendations of the target
+    # users as arrays: the columns of the items and their scores, len(target_users) * rec_length (see
+    # merge_popular), and the mask of the users without neighbours
+    if isinstance(neighbours, dict):
+        neighbour_indices, neighbour_weights = attach_neighbours(neighbours)
+    else:
+        neighbour_indices, neighbour_weights = neighbours
+    # The users that rated an item are a slice of the CSC layout, the transposed URM is the same layout read as CSR.
+    # The layouts are attached, or received already built in an Adjacency, once for all the chunks of a worker
+    adjacency = as_adjacency(user_rating_matrix)
+    csr_urm = adjacency.csr
+    rating_user_matrix = adjacency.csc.transpose()
+    binary_urm = adjacency.binary
+
+    tot = len(target_users)
+    columns = np.empty((tot, rec_length), dtype=np.int64)
+    scores = np.empty((tot, rec_length), dtype=csr_urm.dtype)
+    non_profiled = np.zeros(tot, dtype=bool)
+    # The target users are processed block_size at a time: the rows of the similarity matrix, the items already
+    # seen and the candidate items of a whole block are read with sparse matrix operations
+    for start in range(0, tot, block_size):
+        block_users = target_users[start:start+block_size]
+        similarity_block = neighbours_block(neighbour_indices, neighbour_weights, target_index.encode(block_users),
+                                            csr_urm.shape[0])
+        seen_block = binary_urm[user_index.encode(block_users)]
         # marks as non profiled all the users for which there is no possibility to provide recommendations using
-        # the collaborative filtering user based technique
-        if recommendable_items == 0:
-            non_profiled_users_number += 1
-            non_profiled_users.append(user)
-            user_rated_items[user] = []
-
-        # Provides recommendations for avery one by initializing the recommendation list with the unseen and not expired
-        # top pops to which are assigned negative weights. Then for the user for which is possible the collaborative
-        # filtering technique will estimate the personalized recommendations
-        if counter % 200 == 0:
-            time_print("[", name, "] ", str(counter/len(target_users)*100), "% recommendations provided",
-                       style="Info")
-        counter += 1
-
-        rec_dictionary[user] = \
-            non_personalized_recommendation(rec_length, expired_items, user_rated_items[user])
-
-        # Puts the non-recommendable items in a set in order to get O(1) membership check
-        non_recommendable_set = set(it.chain(expired_items, user_rated_items[user]))
-        # Now for every interested item we compute the estimated rating storing only the @rec_length better ones
-        for item_column in interesting_items:
-            # Checks the estimated rating only for valid item_ids
-            if position_iid_dic[item_column] not in non_recommendable_set:
-                weights = 0
-                for ranker in item_rating_user[item_column]:
-                    weights += similarity_matrix_row[ranker]
+        # the collaborative filtering user based technique: the users without neighbours
+        non_profiled[start:start+len(block_users)] = np.diff(similarity_block.indptr) == 0
+
+        # For every target user we have to compute the similarity for all the interesting items
+        # where interesting means that have been evaluated at least by one of the neighbours, not seen by the user
+        # and not expired
+        candidates = candidate_items(similarity_block, binary_urm, seen_block, expired_columns)
+
+        # The estimated ratings are stored in the order of the candidates, then only the rec_length best of each
+        # user are selected
+        estimated_ratings = np.empty(candidates.nnz, dtype=csr_urm.dtype)
+        for counter in range(len(block_users)):
+            # The row of the similarity matrix corresponding to our user
+            sim_sparse_row = similarity_block[counter]
+            similarity_matrix_row = sim_sparse_row.toarray().ravel()
+            for position in range(candidates.indptr[counter], candidates.indptr[counter+1]):
+                item_column = candidates.indices[position]
+                weights = similarity_matrix_row[adjacency.item_users(item_column)].sum()
                 if weights == 0:
                     weights = 1
                 estimated_rating_dirty =\
                     np.asarray((sim_sparse_row.dot(rating_user_matrix.getrow(item_column).T).todense())).ravel()
-                estimated_rating = estimated_rating_dirty / weights
-                # To debug we signal when the estimated rating is not present
-                if len(estimated_rating) == 0:
-                    print("D'oh")
-                    estimated_rating = [0]
-                new_tuple = position_iid_dic[item_column], estimated_rating[0]
-                rec_dictionary[user].append(new_tuple)
+                estimated_ratings[position] = estimated_rating_dirty[0] / weights
 
-        # Stores in the dictionary only the rec_length best tuples, sorted by estimated rating
-        rec_dictionary[user].sort(key=lambda tup: tup[1], reverse=True)
+        # The unseen and not expired top pops, with negative weights, fill the lists of the users for which the
+        # collaborative filtering technique can not estimate enough personalized recommendations
+        block_columns, block_scores = block_recommendations(candidates, estimated_ratings,
+                                                            popular_unseen(popularity, seen_block, rec_length))
+        columns[start:start+len(block_users)] = block_columns
+        scores[start:start+len(block_users)] = block_scores
 
-        rec_dictionary[user] = rec_dictionary[user][:rec_length]
+        time_print("[", name, "] ", str(min(start+block_size, tot)/tot*100), "% recommendations provided",
+                   style="Info")
 
-    time_print("[", name, "] 100% recommendations provided. "+str(non_profiled_users_number)+"are not profiled",
+    time_print("[", name, "] 100% recommendations provided. "+str(np.count_nonzero(non_profiled))+"are not profiled",
                style="Info")
 
-    return rec_dictionary, non_profiled_users
+    return columns, scores, non_profiled
+
+
+def batch_recommend(neighbours, user_rating_matrix, target_users, target_index, user_index, item_index,
+                    rec_length, expired_columns, popularity, name="Generic Rec-Sys", block_size=1000):
+    # Batch version of recommend, same output, built from the arrays of batch_recommend_arrays
+    columns, scores, non_profiled = batch_recommend_arrays(neighbours, user_rating_matrix, target_users,
+                                                           target_index, user_index, rec_length, expired_columns,
+                                                           popularity, name, block_size)
+    rec_dictionary = dict(zip(target_users, recommendation_lists(recommended_items(columns, item_index), scores)))
+    return rec_dictionary, list(np.asarray(target_users)[non_profiled])
+
+
+def batch_recommend_arrays(neighbours, user_rating_matrix, target_users, target_index, user_index, rec_length,
+                           expired_columns, popularity, name="Generic Rec-Sys", block_size=1000):
+    # Batch version of recommend_arrays, same output. The estimated ratings of a block of target users are computed
+    # at once: the numerators are S_block @ URM and the normalizers |S_block| @ binarized(URM), read at the
+    # candidate items of candidate_items
+    # The URM is a sparse matrix, a descriptor of share_matrix or an Adjacency with all its layouts already built
+    if isinstance(neighbours, dict):
+        neighbour_indices, neighbour_weights = attach_neighbours(neighbours)
+    else:
+        neighbour_indices, neighbour_weights = neighbours
+    adjacency = as_adjacency(user_rating_matrix)
+    user_rating_matrix = adjacency.csr
+    binary_urm = adjacency.binary
+
+    tot = len(target_users)
+    columns = np.empty((tot, rec_length), dtype=np.int64)
+    scores = np.empty((tot, rec_length), dtype=user_rating_matrix.dtype)
+    non_profiled = np.zeros(tot, dtype=bool)
+    for start in range(0, tot, block_size):
+        block_users = target_users[start:start+block_size]
+        similarity_rows = target_index.encode(block_users)
+        urm_rows = user_index.encode(block_users)
+
+        # Users without neighbours can only receive non personalized recommendations
+        similarity_block = neighbours_block(neighbour_indices, neighbour_weights, similarity_rows,
+                                            user_rating_matrix.shape[0])
+        non_profiled[start:start+len(block_users)] = np.diff(similarity_block.indptr) == 0
+
+        # Numerators and normalizers of the estimated ratings of all the candidate items of the block, the items
+        # already seen by the user and the expired ones are not candidates
+        block_binary_urm = binary_urm[urm_rows]
+        candidates = candidate_items(similarity_block, binary_urm, block_binary_urm, expired_columns)
+        numerators = similarity_block.dot(user_rating_matrix).tocsr()
+        normalizers = abs(similarity_block).dot(binary_urm).tocsr()
+        estimated_ratings = sparse_values_at(numerators, candidates) / sparse_values_at(normalizers, candidates)
+
+        # The personalized recommendations are merged with the non personalized ones, that have negative weights
+        block_columns, block_scores = block_recommendations(candidates, estimated_ratings,
+                                                            popular_unseen(popularity, block_binary_urm, rec_length))
+        columns[start:start+len(block_users)] = block_columns
+        scores[start:start+len(block_users)] = block_scores
+
+        time_print("[", name, "] ", str(min(start+block_size, tot)/tot*100), "% recommendations provided",
+                   style="Info")
+
+    time_print("[", name, "] 100% recommendations provided. "+str(np.count_nonzero(non_profiled))+"are not profiled",
+               style="Info")
+
+    return columns, scores, non_profiled
+
+
+def block_recommendations(candidates, estimated_ratings, popular_columns):
+    # Recommendations of a block of users, as the arrays of merge_popular: the rec_length best candidates of each
+    # user (estimated_ratings follows the order of the elements of candidates) merged with the non personalized
+    # recommendations of popular_unseen
+    rec_length = popular_columns.shape[1]
+    positions = top_n(candidates.indptr, estimated_ratings, rec_length)
+    chosen = positions >= 0
+    columns = -np.ones(positions.shape, dtype=np.int64)
+    scores = np.full(positions.shape, np.nan, dtype=estimated_ratings.dtype)
+    columns[chosen] = candidates.indices[positions[chosen]]
+    scores[chosen] = estimated_ratings[positions[chosen]]
+    return merge_popular(columns, scores, popular_columns)
+
+
+def top_n(indptr, values, n):
+    # Positions in values of the n greatest values of each row of a CSR matrix (indptr and data), as a matrix
+    # rows * n sorted by decreasing value and padded with -1 for the rows with less than n values. The n best of a
+    # row are found with np.argpartition and only them are sorted, O(values) instead of O(values log values). The
+    # ties keep the order of the row, as a stable sort would
+    positions = -np.ones((len(indptr) - 1, n), dtype=np.int64)
+    if n == 0:
+        return positions
+    for row in range(len(indptr) - 1):
+        start, end = indptr[row], indptr[row+1]
+        row_values = values[start:end]
+        if end - start > n:
+            # The values greater than the n-th one are all chosen, the ones equal to it in order until n
+            threshold = row_values[np.argpartition(-row_values, n - 1)[n - 1]]
+            greater = np.flatnonzero(row_values > threshold)
+            chosen = np.concatenate((greater, np.flatnonzero(row_values == threshold)[:n - len(greater)]))
+            chosen.sort()
+        else:
+            chosen = np.arange(end - start)
+        chosen = chosen[np.argsort(-row_values[chosen], kind='stable')]
+        positions[row, :len(chosen)] = start + chosen
+    return positions
+
+
+def merge_popular(columns, scores, popular_columns):
+    # Merges the personalized recommendations of a block of users, columns and scores padded with -1 columns, with
+    # the non personalized ones of popular_unseen, that get the weights -2, -3, ... On equal scores the popular
+    # items come first. Returns the rec_length best of each user as two matrices users * rec_length: the columns of
+    # the items, padded with -1, and their scores, padded with NaN
+    rec_length = popular_columns.shape[1]
+    popular_scores = np.where(popular_columns >= 0, -2.0 - np.arange(rec_length), -np.inf)
+    all_columns = np.hstack((popular_columns, columns))
+    all_scores = np.hstack((popular_scores, np.where(columns >= 0, scores, -np.inf))).astype(scores.dtype)
+    order = np.argsort(-all_scores, axis=1, kind='stable')[:, :rec_length]
+    merged_columns = np.take_along_axis(all_columns, order, axis=1)
+    merged_scores = np.take_along_axis(all_scores, order, axis=1)
+    return merged_columns, np.where(merged_columns >= 0, merged_scores, np.nan).astype(scores.dtype)
+
+
+def recommended_items(columns, item_index):
+    # The ids of the items in the given columns, as an object array with None in place of the padding of
+    # merge_popular: no sentinel id can be mixed with ids of any type (numbers or strings)
+    items = np.full(columns.shape, None, dtype=object)
+    chosen = columns >= 0
+    items[chosen] = item_index.decode(columns[chosen])
+    return items
+
+
+def recommendation_lists(items, scores):
+    # Turns the rows of the arrays of recommendations into lists of (item_id, score), without the padding
+    lengths = np.count_nonzero(~np.isnan(scores), axis=1)
+    return [list(zip(row_items[:length].tolist(), row_scores[:length]))
+            for row_items, row_scores, length in zip(items, scores, lengths)]
+
+
+def binarized(matrix):
+    # The CSR matrix with the same sparsity pattern of matrix and all its elements equal to one
+    matrix = matrix.tocsr()
+    return sps.csr_matrix((np.ones(len(matrix.indices), dtype=matrix.dtype), matrix.indices, matrix.indptr),
+                          shape=matrix.shape)
+
+
+def candidate_items(similarity_block, binary_urm, seen_block, expired_columns):
+    # Candidate items of a block of users, as a boolean CSR matrix users * items with sorted indices: the items
+    # rated by at least one neighbour of the user, i.e. the sparsity pattern of binarized(S_block) @ binarized(URM),
+    # without the ones already seen by the user (the elements of seen_block) and the expired ones
+    candidates = binarized(similarity_block).dot(binary_urm).tocsr()
+    candidates.sort_indices()
+    seen = sparse_values_at(seen_block.tocsr(), candidates) > 0
+    candidates = sps.csr_matrix((~(seen | expired_columns[candidates.indices]), candidates.indices,
+                                 candidates.indptr), shape=candidates.shape)
+    candidates.eliminate_zeros()
+    return candidates
+
+
+def sparse_values_at(matrix, pattern):
+    # Returns the values of matrix at the nonzero positions of pattern, in the order of pattern.data, with
+    # zeros where matrix has no element. Both matrices are CSR with the same shape and sorted indices
+    matrix.sort_indices()
+    if matrix.nnz == 0:
+        return np.zeros(pattern.nnz)
+    matrix_keys = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr)) * matrix.shape[1] \
+        + matrix.indices
+    pattern_keys = np.repeat(np.arange(pattern.shape[0], dtype=np.int64), np.diff(pattern.indptr)) * \
+        pattern.shape[1] + pattern.indices
+    positions = np.minimum(np.searchsorted(matrix_keys, pattern_keys), len(matrix_keys) - 1)
+    return np.where(matrix_keys[positions] == pattern_keys, matrix.data[positions], 0)
 
 
 def write_recommendations(recommendations_dic, target_users, user_caption="user_id",
@@ -519,66 +1679,279 @@ def write_recommendations(recommendations_dic, target_users, user_caption="user_
     time_print("Output operations concluded")
 
 
-def check_expiration():
-    # Returns a list in which all the items that are expired are stored
-    # Import the item description file in a Pandas data frame
-    filename = "data/competition/item_profile.csv"
-
-    # This list contains the id's of all the expired items
-    expired_ids = []
-    with open(filename, 'r') as f:
-        item_profiles_reader = pd.read_csv(filename, delimiter='\t')
-
-    expired_items = item_profiles_reader[item_profiles_reader.active_during_test == 0]
+def check_expiration(filename="data/competition/item_profile.csv"):
+    # Returns an array with the ids of all the items that are expired
+    # Data sets without item profiles (e.g. ml100k) have no expired items
+    if filename is None or not os.path.exists(filename):
+        time_print("No item profiles found in ", filename, ", no item is expired", style="Info")
+        return np.zeros(0, dtype=np.int64)
 
-    for i, row in expired_items.iterrows():
-        expired_ids.append(row["id"])
-
-    f.close()
-
-    # return the list of invalid item_id
-    return expired_ids
+    # Import the item description file in a Pandas data frame
+    item_profiles_reader = pd.read_csv(filename, delimiter='\t', usecols=["id", "active_during_test"])
+
+    # return the array of invalid item_id
+    return item_profiles_reader["id"].values[item_profiles_reader["active_during_test"].values == 0]
+
+
+def expired_mask(expired_items, item_index):
+    # Boolean mask over the columns of the URM, True for the expired items. Built once, it excludes the expired
+    # items from the recommendations of a whole block of users by array masking
+    positions = item_index.encode(expired_items)
+    mask = np.zeros(len(item_index), dtype=bool)
+    mask[positions[positions >= 0]] = True
+    return mask
+
+
+def popularity_ranking(user_rating_matrix, expired_columns):
+    # Returns the columns of the URM sorted by popularity, most popular first: the popularity of an item is the
+    # number of users that interacted with it (the ties keep the order of the columns). The expired items and the
+    # ones without interactions are left out. Computed once, it is the fallback for the users that can not receive
+    # enough personalized recommendations, whatever the data set
+    popularity = user_rating_matrix.getnnz(axis=0)
+    ranking = np.argsort(-popularity, kind='stable')
+    return ranking[~expired_columns[ranking] & (popularity[ranking] > 0)].astype(INDEX_DTYPE)
+
+
+def popular_unseen(popularity, seen_rows, rec_length):
+    # For each row of seen_rows, a sparse matrix users * items whose elements are the items already seen, returns the
+    # first rec_length columns of the popularity ranking not seen, as a matrix users * rec_length filled with -1 when
+    # the ranking runs out. Only the top of the ranking is read: rec_length items more than the most items seen by
+    # one of the users
+    seen_rows = seen_rows.tocsr()
+    most_seen = np.diff(seen_rows.indptr).max() if seen_rows.shape[0] > 0 else 0
+    candidates = popularity[:rec_length + most_seen]
+    seen = seen_rows[:, candidates].toarray() != 0
+    # A stable sort of the seen flags moves the unseen candidates first, keeping their order
+    order = np.argsort(seen, axis=1, kind='stable')[:, :rec_length]
+    chosen = np.where(np.take_along_axis(seen, order, axis=1), -1, candidates[order])
+    return np.hstack((chosen, -np.ones((seen_rows.shape[0], rec_length - chosen.shape[1]), dtype=chosen.dtype)))
 
 
 # TODO think about how to set the weights for the top pop suggestions (are they better or worse of an item similar
 # but with a rating worse than your average rating?
-def non_personalized_recommendation(rec_length, expired_items, user_rated_items):
-    # For reasons of time this function is absolutely data-set dependent.
-    top_100_pops = [1053452, 2778525, 1244196, 1386412, 657183, 2791339, 536047, 2002097, 1092821, 784737, 1053542,
-                    278589, 79531, 1928254, 1133414, 1162250, 1984327, 343377, 1742926, 1233470, 1140869, 830073,
-                    460717, 1576126, 2532610, 1443706, 1201171, 2593483, 1056667, 1754395, 1237071, 1117449, 734196,
-                    437245, 266412, 2371338, 823512, 2106311, 1953846, 2413494, 2796479, 1776330, 365608, 1165605,
-                    2031981, 2402625, 1679143, 2487208, 315676, 1069281, 818215, 419011, 931519, 470426, 1695664,
-                    2795800, 2313894, 1119495, 2091019, 2086041, 84304, 72465, 499178, 2156629, 906846, 468120,
-                    1427250, 117018, 471520, 2466095, 1920047, 1830993, 2198329, 335428, 2512859, 1500071, 2037855,
-                    434392, 951143, 972388, 1047625, 2350341, 2712481, 542469, 1123592, 152021, 1244787, 1899627,
-                    625711, 1330328, 2462072, 1419444, 2590849, 1486097, 1788671, 2175889, 110711,
-                    16356, 291669, 313851]
-
-    to_recommend = []
-    weight = -2
-    counter = 0
-
-    # Builds the non recommendable set as a set to ensure 0(1) membership check
-    non_recommendable_set = set(it.chain(expired_items, user_rated_items))
-
-    for item in top_100_pops:
-        if item not in non_recommendable_set:
-            to_recommend.append((item, weight))
-            weight -= 1
-            counter += 1
-            if counter == rec_length:
-                break
-
-    for i in range(0, rec_length-counter):
-        to_recommend.append((0, weight))
-        weight -= 1
-
-    return to_recommend
+def non_personalized_recommendation(popular_columns, item_index):
+    # Turns the columns returned by popular_unseen into the recommendations of each user of a block: lists of
+    # (item, weight) with decreasing negative weights. The users that have seen all the ranking get shorter lists
+    weights = list(range(-2, -2 - popular_columns.shape[1], -1))
+    items = item_index.decode(np.maximum(popular_columns, 0))
+    lengths = np.count_nonzero(popular_columns >= 0, axis=1)
+    return [list(zip(row[:length].tolist(), weights)) for row, length in zip(items, lengths)]
+
+
+def fallback_recommendations(users, popularity, item_index, rec_length):
+    # Recommendations of the users without interactions: nothing was seen by them, so all of them get the first
+    # rec_length items of the popularity ranking. Returns a dictionary user_id -> list of (item, weight)
+    recommendation = non_personalized_recommendation(
+        popular_unseen(popularity, sps.csr_matrix((1, len(item_index))), rec_length), item_index)[0]
+    return {user: list(recommendation) for user in users}
+
+
+class UserKNNRecommender:
+    # User based collaborative filtering model. Its state (URM, id indexes, nearest neighbours of the target users,
+    # expired items and popularity ranking) lives in the instance instead of in module globals: fit() builds it
+    # once, then recommend() can be called any number of times, so a long-lived process keeps a warm model and pays
+    # the ingestion, URM and similarity costs only once. The options are the ones of main
+    def __init__(self, k=63, rec_length=5, user_key="user_id", item_key="item_id", rating_key="rating",
+                 _item_bias_=1, _user_bias_=1, user_damping=0, item_damping=0, normalize_rows=True,
+                 ingestion_mode="columnar", block_size=1000, share_mode="shm", number_of_cpu=None, chunk_size=250,
+                 scoring_mode="batch", cache_dir=None, urm_file=None, similarity_matrix_file=None, delimiter='\t',
+                 item_profile_file="data/competition/item_profile.csv", memory_budget=1024, interaction_store=None,
+                 time_key="created_at", precision="float32", delta_files=()):
+        self.k = k
+        self.rec_length = rec_length
+        self.user_key = user_key
+        self.item_key = item_key
+        self.rating_key = rating_key
+        self.item_bias = _item_bias_
+        self.user_bias = _user_bias_
+        self.user_damping = user_damping
+        self.item_damping = item_damping
+        self.normalize_rows = normalize_rows
+        self.ingestion_mode = ingestion_mode
+        self.block_size = block_size
+        self.share_mode = share_mode
+        self.number_of_cpu = number_of_cpu
+        self.chunk_size = chunk_size
+        self.scoring_mode = scoring_mode
+        self.cache_dir = cache_dir
+        self.urm_file = urm_file
+        self.similarity_matrix_file = similarity_matrix_file
+        self.delimiter = delimiter
+        self.item_profile_file = item_profile_file
+        self.memory_budget = memory_budget
+        self.interaction_store = interaction_store
+        self.time_key = time_key
+        self.precision = precision
+        self.delta_files = delta_files
+
+        # State of the fitted model
+        self.target_users = None
+        self.target_index = None
+        # Mask over the target users, True for the ones with some interaction
+        self.profiled = None
+        # Mask over the rows of the URM, True for the users with some interaction
+        self.interacting = None
+        self.neighbours = None
+        self.user_rating_matrix = None
+        # Layouts of the URM read by the scoring functions (see Adjacency), built or attached once
+        self.adjacency = None
+        self.user_index = None
+        self.item_index = None
+        self.expired_columns = None
+        self.popularity = None
+        # Descriptors of the URM and of the neighbours in shared memory, None in pickle mode
+        self.shared_urm = None
+        self.shared_neighbours = None
+        # Finalizers freeing the shared memory of a fitted model that is garbage collected, or still alive when the
+        # interpreter exits, without an explicit release()
+        self.finalizers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+    def fit(self, interactions, target_users_file=None):
+        # Builds the URM and the nearest neighbours of the target users (or loads them from the cache), the mask of
+        # the expired items and the popularity ranking. A model fitted again releases its previous state first
+        self.release()
+        self.target_users, self.target_index, self.profiled, self.neighbours, user_rating_matrix, self.user_index, \
+            self.item_index, row_number, col_number, self.shared_urm, self.shared_neighbours = \
+            user_knn(interactions, target_users_file, self.k, self.user_key, self.item_key, self.rating_key,
+                     self.item_bias, self.user_bias, self.ingestion_mode, self.block_size, self.share_mode,
+                     self.number_of_cpu, self.cache_dir, self.urm_file, self.similarity_matrix_file,
+                     self.user_damping, self.item_damping, self.delimiter, self.memory_budget,
+                     self.interaction_store, self.time_key, self.precision, self.delta_files, self.normalize_rows)
+        # user_knn frees its shared memory when it fails, from here on a failed fit releases it
+        try:
+            # The URM is kept in CSR, the layout read by the scoring functions
+            self.user_rating_matrix = user_rating_matrix.tocsr()
+            self.interacting = self.user_rating_matrix.getnnz(axis=1) > 0
+            self.adjacency = Adjacency(self.shared_urm if self.shared_urm is not None else self.user_rating_matrix)
+
+            # The expired items are excluded through a mask over the columns of the URM and, once for all, from the
+            # popularity ranking used for the non personalized recommendations
+            self.expired_columns = expired_mask(check_expiration(self.item_profile_file), self.item_index)
+            self.popularity = popularity_ranking(self.user_rating_matrix, self.expired_columns)
+
+            # The URM is already shared by user_knn, as the neighbours arrays when they were just computed. The ones
+            # loaded from the cache are shared here
+            if self.share_mode != "pickle" and self.shared_neighbours is None:
+                self.shared_neighbours = share_neighbours(self.neighbours, self.share_mode)
+        except BaseException:
+            self.release()
+            raise
+        self.finalizers = [weakref.finalize(self, release_shared, descriptor)
+                           for descriptor in (self.shared_urm, self.shared_neighbours) if descriptor is not None]
+        return self
+
+    def recommend(self, user_ids):
+        # Recommendations of the given users, computed in this process with the fitted model: a dictionary
+        # user_id -> list of rec_length (item_id, estimated_rating), built from the arrays of recommend_batch
+        user_ids = pd.unique(np.asarray(user_ids))
+        items, scores = self.recommend_batch(user_ids)
+        return dict(zip(user_ids, recommendation_lists(items, scores)))
+
+    def recommend_batch(self, user_ids):
+        # Recommendations of an array of user ids as two arrays len(user_ids) * rec_length, in the order of user_ids:
+        # the ids of the recommended items (an object array), best first, and their scores. The rows with less
+        # than rec_length recommendations are padded with None in place of the item id and a NaN score. The target
+        # users read their neighbours from the model, the other users of the URM get them computed now, the users
+        # without interactions and the unknown ones get the most popular items
+        user_ids = np.asarray(user_ids)
+        rows = self.user_index.encode(user_ids)
+        profiled = rows >= 0
+        profiled[profiled] = self.interacting[rows[profiled]]
+        dtype = self.user_rating_matrix.dtype
+        popular_columns = popular_unseen(self.popularity, sps.csr_matrix((len(user_ids), len(self.item_index))),
+                                         self.rec_length)
+        columns, scores = merge_popular(np.empty((len(user_ids), 0), dtype=INDEX_DTYPE),
+                                        np.empty((len(user_ids), 0), dtype=dtype), popular_columns)
+
+        # Every profiled user is scored once, whatever the times it appears in user_ids
+        profiled_users = pd.unique(user_ids[profiled])
+        if len(profiled_users) > 0:
+            profiled_index = IdIndex(profiled_users)
+            scorer = batch_recommend_arrays if self.scoring_mode == "batch" else recommend_arrays
+            profiled_columns, profiled_scores, non_profiled = \
+                scorer(self.user_neighbours(profiled_users), self.adjacency, profiled_users, profiled_index,
+                       self.user_index, self.rec_length, self.expired_columns, self.popularity, "UserKNNRecommender",
+                       block_size=self.block_size)
+            positions = profiled_index.encode(user_ids[profiled])
+            columns[profiled] = profiled_columns[positions]
+            scores[profiled] = profiled_scores[positions]
+        return recommended_items(columns, self.item_index), scores
+
+    def user_neighbours(self, user_ids):
+        # The (indices, weights) arrays of the nearest neighbours of users of the URM, one row for each of them: the
+        # rows of the target users are read from the model, the ones of the other users are computed by row_dealer
+        positions = self.target_index.encode(user_ids)
+        known = positions >= 0
+        neighbour_indices = np.zeros((len(user_ids), self.k), dtype=INDEX_DTYPE)
+        neighbour_weights = np.zeros((len(user_ids), self.k), dtype=self.user_rating_matrix.dtype)
+        neighbour_indices[known] = self.neighbours[0][positions[known]]
+        neighbour_weights[known] = self.neighbours[1][positions[known]]
+        if not known.all():
+            neighbour_indices[~known], neighbour_weights[~known] = \
+                row_dealer(self.adjacency, user_ids[~known], self.user_index, "UserKNNRecommender", self.k,
+                           self.block_size)
+        return neighbour_indices, neighbour_weights
+
+    def recommend_targets(self):
+        # Recommendations of all the target users, scored in parallel. The target users without interactions get
+        # directly the most popular items, only the other ones are split in chunks of chunk_size users, dealt
+        # dynamically to the workers. Returns the dictionary of recommendations and the users that got only the
+        # non personalized ones
+        profiled_users = np.asarray(self.target_users)[self.profiled]
+        tot = len(profiled_users)
+        chunks = [{"target_users": profiled_users[start:start+self.chunk_size],
+                   "name": "Chunk " + str(start // self.chunk_size)}
+                  for start in range(0, tot, self.chunk_size)]
+        # Every chunk is scored by blocks of block_size users, whose candidate items are found with sparse products.
+        # In pickle mode the workers receive once the layouts of the URM built by fit
+        arguments = {"neighbours": self.neighbours, "user_rating_matrix": self.adjacency,
+                     "target_index": self.target_index, "user_index": self.user_index, "item_index": self.item_index,
+                     "rec_length": self.rec_length, "expired_columns": self.expired_columns,
+                     "popularity": self.popularity, "block_size": self.block_size}
+        if self.share_mode != "pickle":
+            arguments.update({"neighbours": self.shared_neighbours, "user_rating_matrix": self.shared_urm})
+        if self.scoring_mode == "batch":
+            results = schedule(batch_recommend, arguments, chunks, self.number_of_cpu)
+        else:
+            results = schedule(recommend, arguments, chunks, self.number_of_cpu)
+
+        # Ensembles the results of the single workers in a single dictionary with recommendations
+        time_print("Assembling the final complete dictionary")
+        non_profiled_users = np.asarray(self.target_users)[~self.profiled].tolist()
+        rec_dictionary = fallback_recommendations(non_profiled_users, self.popularity, self.item_index,
+                                                  self.rec_length)
+        for rec_dic, non_int_users in results:
+            rec_dictionary.update(rec_dic)
+            non_profiled_users.extend(non_int_users)
+        return rec_dictionary, non_profiled_users
+
+    def release(self):
+        # Frees the shared memory of the model. The views on the shared neighbours are dropped first, the model has
+        # to be fitted again before recommending. Called at the end of a with block
+        self.neighbours = None
+        self.adjacency = None
+        for finalizer in self.finalizers:
+            finalizer.detach()
+        self.finalizers = []
+        release_shared(self.shared_urm)
+        release_shared(self.shared_neighbours)
+        self.shared_urm = None
+        self.shared_neighbours = None
 
 
 def main(interactions, target_users_file=None, k = 60, user_key="user_id", item_key="item_id", rating_key="interaction_type",
-         rec_length=5, _item_bias_=1, _user_bias_=1):
+         rec_length=5, _item_bias_=1, _user_bias_=1, ingestion_mode="dict", block_size=1000, share_mode="pickle",
+         number_of_cpu=None, chunk_size=250, scoring_mode="item", cache_dir=None, urm_file=None,
+         similarity_matrix_file=None, user_damping=0, item_damping=0, delimiter='\t',
+         item_profile_file="data/competition/item_profile.csv", memory_budget=1024, interaction_store=None,
+         time_key="created_at", precision="float32", delta_files=()):
 
     # Setting the timers
     global last_time
@@ -587,59 +1960,14 @@ def main(interactions, target_users_file=None, k = 60, user_key="user_id", item_
     time_offset = last_time
 
     # building the matrices needed in order to recommend the right items
-    target_users, similarity_matrix, new_uid_position, user_rating_matrix, position_iid_dic, \
-        position_uid_dic, iid_position_dic, uid_position_dic, row_number, col_number, similar_users_columns, \
-        user_rated_items, item_rating_user = user_knn(interactions, target_users_file, k, user_key, item_key,
-                                                      rating_key, _item_bias_, _user_bias_)
-
-    expired_items = check_expiration()
-
-    # Splits the work between 4 worker in order to exploit all the 4 CPUs of my machine
-    pool = multiprocessing.Pool()
-    tot = len(target_users)
-    step = int(tot/4)
-
-    first_rec_dictionary_process = pool.apply_async(recommend, (similarity_matrix, user_rating_matrix,
-                                                                target_users[0:step], new_uid_position,
-                                                                position_iid_dic, position_uid_dic,
-                                                                user_rated_items, rec_length, expired_items, "One",
-                                                                item_rating_user,))
-    second_rec_dictionary_process = pool.apply_async(recommend, (similarity_matrix, user_rating_matrix,
-                                                                 target_users[step:2*step], new_uid_position,
-                                                                 position_iid_dic, position_uid_dic,
-                                                                 user_rated_items, rec_length, expired_items, "Two",
-                                                                 item_rating_user,))
-    third_rec_dictionary_process = pool.apply_async(recommend, (similarity_matrix, user_rating_matrix,
-                                                                target_users[2*step:3*step], new_uid_position,
-                                                                position_iid_dic, position_uid_dic,
-                                                                user_rated_items, rec_length, expired_items, "Three",
-                                                                item_rating_user,))
-    fourth_rec_dictionary_process = pool.apply_async(recommend, (similarity_matrix, user_rating_matrix,
-                                                                 target_users[3*step:4*step], new_uid_position,
-                                                                 position_iid_dic, position_uid_dic,
-                                                                 user_rated_items, rec_length, expired_items, "Four",
-                                                                 item_rating_user,))
-
-    # Fetches the results of the single workers
-    first_rec_dic, first_non_int_users = first_rec_dictionary_process.get()
-    second_rec_dic, second_non_int_users = second_rec_dictionary_process.get()
-    third_rec_dic, third_non_int_users = third_rec_dictionary_process.get()
-    fourth_rec_dic, fourth_non_int_users = fourth_rec_dictionary_process.get()
-
-    # Ensembles the results in a single dictionary with recommendations
-    non_profiled_users = np.hstack((first_non_int_users, second_non_int_users))
-    non_profiled_users = np.hstack((non_profiled_users, third_non_int_users))
-    non_profiled_users = np.hstack((non_profiled_users, fourth_non_int_users))
-
-    # Assembling the final complete dictionary
-    time_print("Assembling the final complete dictionary")
-    rec_dictionary = dict(first_rec_dic)
-    rec_dictionary.update(second_rec_dic)
-    rec_dictionary.update(third_rec_dic)
-    rec_dictionary.update(fourth_rec_dic)
-
-    pool.close()
-    pool.terminate()
+    model = UserKNNRecommender(k, rec_length, user_key, item_key, rating_key, _item_bias_, _user_bias_, user_damping,
+                               item_damping, args.normalize, ingestion_mode, block_size, share_mode, number_of_cpu,
+                               chunk_size, scoring_mode, cache_dir, urm_file, similarity_matrix_file, delimiter,
+                               item_profile_file, memory_budget, interaction_store, time_key, precision, delta_files)
+    model.fit(interactions, target_users_file)
+    rec_dictionary, non_profiled_users = model.recommend_targets()
+    target_users = model.target_users
+    model.release()
 
     # Writing the recommendations file
     time_print("Writing the recommendations files")
@@ -651,6 +1979,16 @@ def main(interactions, target_users_file=None, k = 60, user_key="user_id", item_
 
     print(len(non_profiled_users))
 
-main(args.rating_file, args.target_users, k=args.k,
-     _item_bias_=args.item_bias, _user_bias_=args.user_bias, rating_key=args.rating_key, rec_length=args.rec_length,
-     user_key=args.user_key, item_key=args.item_key)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.rating_file, args.target_users, k=args.k,
+         _item_bias_=args.item_bias, _user_bias_=args.user_bias, rating_key=args.rating_key,
+         rec_length=args.rec_length, user_key=args.user_key, item_key=args.item_key,
+         ingestion_mode=args.ingestion_mode, block_size=args.block_size, share_mode=args.share_mode,
+         number_of_cpu=args.number_of_cpu, chunk_size=args.chunk_size, scoring_mode=args.scoring_mode,
+         cache_dir=args.cache_dir, urm_file=args.urm_file, similarity_matrix_file=args.similarity_matrix_file,
+         user_damping=args.user_bias_damping, item_damping=args.item_bias_damping, delimiter=args.delimiter,
+         item_profile_file=args.item_profile_file, memory_budget=args.memory_budget,
+         interaction_store=args.interaction_store, time_key=args.time_key, precision=args.precision,
+         delta_files=args.delta_files)
@@ -32,6 +32,8 @@ parser.add_argument('--normalize', type=bool, default=True)
 parser.add_argument('--prediction_file', type=str, default=None)
 parser.add_argument('--user_bias', type=bool, default=True)
 parser.add_argument('--item_bias', type=bool, default=True)
+parser.add_argument('--user_bias_damping', type=float, default=0)
+parser.add_argument('--item_bias_damping', type=float, default=0)
 parser.add_argument('--rec_length', type=int, default=5)
 parser.add_argument('--verbosity_level', type=str, default="Info")
 args = parser.parse_args()
@@ -73,61 +75,26 @@ class DataContainer:
 def urm_computer():
     # Building the user rating matrix starting from the dictionary of interactions
 
-    # Counting to get the elements to average the user
-    u.time_print("Calculating the user bias", style="Info")
-    user_number = {}
-    user_total = {}
-    user_average = {}
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        user = key[0]
-        if user in user_total.keys():
-            user_total[user] += DataContainer.user_rating_dictionary[key]
-            user_number[user] += 1
-        else:
-            user_total[user] = DataContainer.user_rating_dictionary[key]
-            user_number[user] = 1
-
-    # Computes the average and stores it only if the user_bias arg is set to True
-    for user in user_number.keys():
-        user_average[user] = user_total[user] / user_number[user] * 1 if args.user_bias else 0
-
-    # Counting to get the elements to average the item
-    u.time_print("Calculating the item bias", style="Info")
-    item_number = {}
-    item_total = {}
-    item_average = {}
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        item = key[1]
-        user = key[0]
-        if item in item_total.keys():
-            item_total[item] += DataContainer.user_rating_dictionary[key] - user_average[user]
-            item_number[item] += 1
-        else:
-            item_total[item] = DataContainer.user_rating_dictionary[key] - user_average[user]
-            item_number[user] = 1
+    u.time_print("Calculating the user and item biases", style="Info")
+    # The dictionary of interactions is converted in the COO arrays, one element for each (user, item) couple
+    keys = np.array(list(DataContainer.user_rating_dictionary.keys()), dtype=np.int64).reshape(-1, 2)
+    values = np.fromiter(DataContainer.user_rating_dictionary.values(), dtype=np.float64,
+                         count=len(DataContainer.user_rating_dictionary))
+    values, user_average, item_average = \
+        u.remove_biases(keys[:, 0], keys[:, 1], values, DataContainer.number_of_users, DataContainer.number_of_items,
+                        1 if args.user_bias else 0, 1 if args.item_bias else 0, args.user_bias_damping,
+                        args.item_bias_damping)
 
-    # Computes the average and stores it only if the item_bias arg is set to True
-    for item in item_number.keys():
-        item_average[item] = item_total[item] / item_number[item] * 1 if args.item_bias else 0
-
-    # Builds the array necessary to build the sparse matrix
     u.time_print("Converting the urm to a sparse representation", style="Info")
-    data = []
-    row_indices = []
-    col_indices = []
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        user = key[0]
-        item = key[1]
-        row_indices.append(user)
-        col_indices.append(item)
-        data.append(DataContainer.user_rating_dictionary[(user, item)] - item_average[item] - user_average[user])
-        if user in DataContainer.user_rated_items.keys():
-            DataContainer.user_rated_items[DataContainer.urm_position_to_uid[user]].append(item)
+    row_indices = keys[:, 0]
+    col_indices = keys[:, 1]
+    data = values
+    for user, item in zip(row_indices.tolist(), col_indices.tolist()):
+        uid = DataContainer.urm_position_to_uid[user]
+        if uid in DataContainer.user_rated_items.keys():
+            DataContainer.user_rated_items[uid].append(item)
         else:
-            DataContainer.user_rated_items[DataContainer.urm_position_to_uid[user]] = [item]
+            DataContainer.user_rated_items[uid] = [item]
 
     DataContainer.user_rating_matrix = \
         sps.csc_matrix((data, (row_indices, col_indices)),
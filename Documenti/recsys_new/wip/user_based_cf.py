@@ -33,141 +33,122 @@ parser.add_argument('--normalize', type=bool, default=True)
 parser.add_argument('--prediction_file', type=str, default=None)
 parser.add_argument('--user_bias', type=bool, default=True)
 parser.add_argument('--item_bias', type=bool, default=True)
+parser.add_argument('--user_bias_damping', type=float, default=0)
+parser.add_argument('--item_bias_damping', type=float, default=0)
 parser.add_argument('--rec_length', type=int, default=5)
 parser.add_argument('--verbosity_level', type=str, default="Info")
 parser.add_argument('--number_of_cpu', type=int, default=4)
 parser.add_argument('--urm_fil', type=str, default=None)
 parser.add_argument('--similarity_matrix_file', type=str, default=None)
 parser.add_argument('--estimations_file', type=str, default=None)
-args = parser.parse_args()
+parser.add_argument('--ingestion_mode', type=str, default="columnar", choices=["dict", "columnar"])
+# Importing the module does not read the command line: the options keep their defaults until the module is run
+# as a script
+args = parser.parse_args([])
+# State of the run handed to each worker by the pool initializer
+worker_data = {}
 
 
 class DataContainer:
-    # user number, item number
-    user_rating_dictionary = {}
-    # number of users, both interactive and non
-    number_of_users = {}
-    # number of all the rated items
-    number_of_items = {}
-    # user number -> user_id
-    urm_position_to_uid = {}
-    # user_id -> user number
-    uid_to_urm_position = {}
-    # item number -> item_id
-    urm_position_to_iid = {}
-    # item_id -> item number
-    iid_to_urm_position = {}
-    # target user number -> user_id
-    target_number_uid = {}
-    # user_id -> target user number
-    uid_target_number = {}
-    # list of the ids of all the target users
-    target_users = []
-    # list of the ids of all the users both interactive and non
-    users = []
-    # list of only the interacting users
-    interacting_users = []
-    # list of all the users without interactions
-    non_profiled_users = []
-    # matrix with a row for every user and a column for every item. The cell contains the vote
-    user_rating_matrix = sps.csc_matrix(([0], ([0], [0])), shape=(1, 1))
-    similarity_matrix = sps.csc_matrix(([0], ([0], [0])), shape=(1, 1))
-    # user_id -> item_number
-    # NOTE: item number is not item_id
-    user_rated_items = {}
-    # item number -> user number
-    item_rating_users = {}
-    # user_id -> neighbour's number
-    user_neighbours = {}
-    # Expired items id
-    expired_items = []
-    # Recommendations dictionary
-    rec_dictionary = {}
-
-
-def urm_computer():
+    # State of a run of the recommender, one instance for each run: nothing is stored in the class, so the module
+    # can be imported and run any number of times in the same process
+    def __init__(self):
+        # user number, item number
+        self.user_rating_dictionary = {}
+        # number of users, both interactive and non
+        self.number_of_users = {}
+        # number of all the rated items
+        self.number_of_items = {}
+        # user number -> user_id
+        self.urm_position_to_uid = {}
+        # user_id -> user number
+        self.uid_to_urm_position = {}
+        # item number -> item_id
+        self.urm_position_to_iid = {}
+        # item_id -> item number
+        self.iid_to_urm_position = {}
+        # target user number -> user_id
+        self.target_number_uid = {}
+        # user_id -> target user number
+        self.uid_target_number = {}
+        # list of the ids of all the target users
+        self.target_users = []
+        # list of the ids of all the users both interactive and non
+        self.users = []
+        # list of only the interacting users
+        self.interacting_users = []
+        # list of all the users without interactions
+        self.non_profiled_users = []
+        # matrix with a row for every user and a column for every item. The cell contains the vote
+        self.user_rating_matrix = sps.csc_matrix(([0], ([0], [0])), shape=(1, 1))
+        self.similarity_matrix = sps.csc_matrix(([0], ([0], [0])), shape=(1, 1))
+        # CSR and CSC layouts of the urm, read by user_items and item_users
+        self.csr_urm = self.user_rating_matrix.tocsr()
+        self.csc_urm = self.user_rating_matrix
+        # user_id -> neighbour's number
+        self.user_neighbours = {}
+        # Expired items id
+        self.expired_items = []
+        # Ids of the items sorted by popularity, without the expired ones
+        self.popular_items = []
+        # Recommendations dictionary
+        self.rec_dictionary = {}
+
+    def user_items(self, row):
+        # Columns of the items rated by the user in the given row of the urm, a slice of its CSR layout
+        return self.csr_urm.indices[self.csr_urm.indptr[row]:self.csr_urm.indptr[row+1]]
+
+    def item_users(self, column):
+        # Rows of the users that rated the item in the given column of the urm, a slice of its CSC layout
+        return self.csc_urm.indices[self.csc_urm.indptr[column]:self.csc_urm.indptr[column+1]]
+
+
+def urm_computer(data):
     # Building the user rating matrix starting from the dictionary of interactions
+    # The dictionary of interactions is converted in the COO arrays, one element for each (user, item) couple
+    keys = np.array(list(data.user_rating_dictionary.keys()), dtype=np.int64).reshape(-1, 2)
+    values = np.fromiter(data.user_rating_dictionary.values(), dtype=np.float64,
+                         count=len(data.user_rating_dictionary))
+    coo_urm_computer(data, keys[:, 0], keys[:, 1], values)
 
-    # Counting to get the elements to average the user
-    u.time_print("Calculating the user bias", style="Info")
-    user_number = {}
-    user_total = {}
-    user_average = {}
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        user = key[0]
-        if user in user_total.keys():
-            user_total[user] += DataContainer.user_rating_dictionary[key]
-            user_number[user] += 1
-        else:
-            user_total[user] = DataContainer.user_rating_dictionary[key]
-            user_number[user] = 1
-
-    # Computes the average and stores it only if the user_bias arg is set to True
-    for user in user_number.keys():
-        user_average[user] = user_total[user]/user_number[user] * 1 if args.user_bias else 0
-
-    # Counting to get the elements to average the item
-    u.time_print("Calculating the item bias", style="Info")
-    item_number = {}
-    item_total = {}
-    item_average = {}
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        item = key[1]
-        user = key[0]
-        if item in item_total.keys():
-            item_total[item] += DataContainer.user_rating_dictionary[key] - user_average[user]
-            item_number[item] += 1
-        else:
-            item_total[item] = DataContainer.user_rating_dictionary[key] - user_average[user]
-            item_number[item] = 1
-
-    # Computes the average and stores it only if the item_bias arg is set to True
-    for item in item_number.keys():
-        item_average[item] = item_total[item]/item_number[item] * 1 if args.item_bias else 0
 
-    # Builds the array necessary to build the sparse matrix
-    u.time_print("Converting the urm to a sparse representation", style="Info")
-    data = []
-    row_indices = []
-    col_indices = []
-
-    for key in DataContainer.user_rating_dictionary.keys():
-        user = key[0]
-        item = key[1]
-        row_indices.append(user)
-        col_indices.append(item)
-        data.append(DataContainer.user_rating_dictionary[(user, item)] - item_average[item] - user_average[user])
-        if DataContainer.urm_position_to_uid[user] in DataContainer.user_rated_items.keys():
-            DataContainer.user_rated_items[DataContainer.urm_position_to_uid[user]].append(item)
-        else:
-            DataContainer.user_rated_items[DataContainer.urm_position_to_uid[user]] = [item]
-        if DataContainer.urm_position_to_iid[item] in DataContainer.item_rating_users.keys():
-            DataContainer.item_rating_users[DataContainer.urm_position_to_iid[item]].append(user)
-        else:
-            DataContainer.item_rating_users[DataContainer.urm_position_to_iid[item]] = [user]
+def coo_urm_computer(data, row_indices, col_indices, values):
+    # Columnar version of urm_computer, working on the COO arrays returned by Utils.columnar_importation
 
-    DataContainer.user_rating_matrix = \
-        sps.csc_matrix((data, (row_indices, col_indices)),
-                       shape=(DataContainer.number_of_users, DataContainer.number_of_items))
+    u.time_print("Calculating the user and item biases", style="Info")
+    values, user_average, item_average = \
+        u.remove_biases(row_indices, col_indices, values, data.number_of_users, data.number_of_items,
+                        1 if args.user_bias else 0, 1 if args.item_bias else 0, args.user_bias_damping,
+                        args.item_bias_damping)
+    user_number = np.bincount(row_indices, minlength=data.number_of_users)
 
-    u.time_print("Building auxiliary Data structures", style="Info")
-    for user in DataContainer.users:
-        if user in DataContainer.user_rated_items.keys():
-            DataContainer.interacting_users.append(user)
-        else:
-            DataContainer.non_profiled_users.append(user)
+    u.time_print("Converting the urm to a sparse representation", style="Info")
+    data.user_rating_matrix = \
+        sps.csc_matrix((values, (row_indices, col_indices)),
+                       shape=(data.number_of_users, data.number_of_items))
+
+    # The ids of the users are in the order of the rows of the urm: the interacting and the non profiled users are
+    # read through a boolean mask over the rows, together with the one of the target users
+    users = np.asarray(data.users)
+    interacting = user_number > 0
+    targets = np.isin(users, data.target_users)
+    data.interacting_users = users[interacting]
+    data.non_profiled_users = users[targets & ~interacting]
 
     if args.normalize :
         u.time_print("Starting the row-wise normalization", style="Info")
-        DataContainer.user_rating_matrix = normalize(DataContainer.user_rating_matrix, 'l2', 1, copy=False)
+        data.user_rating_matrix = normalize(data.user_rating_matrix, norm='l2', axis=1, copy=False)
         u.time_print("Normalization successfully completed")
 
+    # The rated items of the users and the users of the items are read from the two layouts
+    u.time_print("Building auxiliary Data structures", style="Info")
+    data.csr_urm = data.user_rating_matrix.tocsr()
+    data.csc_urm = data.user_rating_matrix.tocsc()
+
     u.time_print("User rating matrix successfully built!")
 
 
-def similarity_matrix_computer():
+def similarity_matrix_computer(data):
     # In order to compute the similarity matrix the procedure to follow
     # is to multiply the urm to its transpose. However, due to the limited
     # amount of available memory it's necessary to perform that product
@@ -177,8 +158,9 @@ def similarity_matrix_computer():
     # Splits the work between one worker for each of the cpu passed as parameters
     u.time_print("Splitting the work between the workers", style="Info")
     children = args.number_of_cpu
-    pool = multiprocessing.Pool()
-    tot_rows = len(DataContainer.target_users)
+    # The state of the run is handed to each worker once, by the pool initializer
+    pool = multiprocessing.Pool(children, initializer=init_worker, initargs=(data,))
+    tot_rows = len(data.target_users)
     step = int(tot_rows/children)
     child_processes = []
 
@@ -195,39 +177,43 @@ def similarity_matrix_computer():
     for i in range(0, children):
         results.append(child_processes[i].get())
 
-    # Merging the obtained results
+    # Merging the obtained results: every worker returns the neighbours of its slice of target users as two
+    # arrays n_targets * k, stacked once in the order of the target users
     u.time_print("Merging the results", style="Info")
-    data = []
-    row_indices = []
-    col_indices = []
+    neighbour_indices = np.vstack([result[0] for result in results])
+    neighbour_weights = np.vstack([result[1] for result in results])
 
-    DataContainer.uid_target_number = dict(results[0][3])
-    DataContainer.target_number_uid = dict(results[0][4])
-    DataContainer.user_neighbours = dict(results[0][5])
+    data.uid_target_number = dict(results[0][2])
+    data.target_number_uid = dict(results[0][3])
+    data.user_neighbours = dict(results[0][4])
 
     for i in range(1, children):
-        data = np.hstack((results[i - 1][0], results[i][0]))
-        row_indices = np.hstack((results[i - 1][1], results[i][1]))
-        col_indices = np.hstack((results[i - 1][2], results[i][2]))
-        DataContainer.uid_target_number.update(results[i][3])
-        DataContainer.target_number_uid.update(results[i][4])
-        DataContainer.user_neighbours.update(results[i][5])
-
-    # Building the similarity matrix as a sparse one
+        data.uid_target_number.update(results[i][2])
+        data.target_number_uid.update(results[i][3])
+        data.user_neighbours.update(results[i][4])
+
+    # Building the similarity matrix as a sparse one: every row is a slice of the arrays, the zero weights used
+    # as padding are dropped
     u.time_print("Building sparse representation of the similarity matrix", style="Info")
-    DataContainer.similarity_matrix = \
-        sps.csc_matrix((data, (row_indices, col_indices)),
-                       shape=(len(DataContainer.target_users), DataContainer.number_of_items))
+    k = neighbour_indices.shape[1]
+    data.similarity_matrix = \
+        sps.csr_matrix((neighbour_weights.ravel(), neighbour_indices.ravel(),
+                        np.arange(len(neighbour_indices) + 1) * k),
+                       shape=(len(data.target_users), data.number_of_users))
+    data.similarity_matrix.eliminate_zeros()
     u.time_print("Similarity matrix built successfully")
 
     return
 
 
+def init_worker(data):
+    # Pool initializer: stores the state of the run in the worker
+    worker_data["data"] = data
+
+
 def row_dealer(start, end, k, thread_number):
+    data = worker_data["data"]
     # Instantiate all the variables needed to collect the results
-    data = []
-    row_ind = []
-    col_ind = []
     user_neighbours = {}
     uid_target_number = {}
     target_number_uid = {}
@@ -237,37 +223,39 @@ def row_dealer(start, end, k, thread_number):
     index = 0
     non_profiled_number = 0
     # Copies the transpose of the user rating matrix
-    rating_user_matrix = DataContainer.user_rating_matrix.transpose(copy=True)
+    rating_user_matrix = data.user_rating_matrix.transpose(copy=True)
 
     # If the end parameter is negative it means that the end is the end of the target users
     if end > 0:
-        targets = DataContainer.target_users[start:end]
+        targets = data.target_users[start:end]
     else:
-        targets = DataContainer.target_users[start:]
+        targets = data.target_users[start:]
 
     # Computes the length of the targets
     total = len(targets)
+    # The neighbours of the targets are written in two arrays total * k, allocated once: the positions of the
+    # neighbours and their weights, padded with zero weights when less than k neighbours are found
+    neighbour_indices = np.zeros((total, k), dtype=np.int64)
+    neighbour_weights = np.zeros((total, k))
 
     # For each one of the targets to be analyzed by the worker
     # the dot product is performed with the transposed of the user rating matrix
     for target in targets:
-        row = DataContainer.uid_to_urm_position[target]
+        row = data.uid_to_urm_position[target]
         uid_target_number[target] = index + start
         target_number_uid[index+start] = target
         sparse_product_line = \
-            DataContainer.user_rating_matrix.getrow(row).dot(rating_user_matrix)
+            data.user_rating_matrix.getrow(row).dot(rating_user_matrix)
         dense_product_line = np.asarray(sparse_product_line.todense()).ravel()
-        dense_product_line[DataContainer.uid_to_urm_position[target]] = 0
+        dense_product_line[data.uid_to_urm_position[target]] = 0
         # Only the k best indices are kept
         if len(dense_product_line.copy().nonzero()[0]) == 0:
             non_profiled_number += 1
         k_nearest_indices = np.argpartition(dense_product_line, -k)[-k:]
-        k_nearest_indices = [k for k in k_nearest_indices if dense_product_line[k] is not 0]
+        k_nearest_indices = k_nearest_indices[dense_product_line[k_nearest_indices] != 0]
         user_neighbours[target] = k_nearest_indices.copy()
-        for i in range(0, k):
-            data = dense_product_line[k_nearest_indices[i]]
-            col_ind = k_nearest_indices[i]
-            row_ind = index+start
+        neighbour_indices[index, :len(k_nearest_indices)] = k_nearest_indices
+        neighbour_weights[index, :len(k_nearest_indices)] = dense_product_line[k_nearest_indices]
 
         index += 1
         if index % 500 == 0:
@@ -276,32 +264,31 @@ def row_dealer(start, end, k, thread_number):
 
     u.time_print("Thread#"+str(thread_number)+":Completion percentage->100%. Process completed")
     print(non_profiled_number)
-    return data, row_ind, col_ind, uid_target_number, target_number_uid, user_neighbours
+    return neighbour_indices, neighbour_weights, uid_target_number, target_number_uid, user_neighbours
 
 
-def recommender(start, end, rec_length, thread_number):
+def recommender(data, start, end, rec_length, thread_number):
     # For all users in target users elaborates recommendations producing a dictionary which
     # associates user_id to (item_id, estimated_rating) in order of rating
     dictionary = {}
     counter = 0
     non_rating_targets = 0
-    for user in DataContainer.target_users[start:end]:
-        rating_user_matrix = DataContainer.user_rating_matrix.transpose(copy=True)
-        user_row = DataContainer.similarity_matrix.getrow(DataContainer.uid_target_number[user])
+    for user in data.target_users[start:end]:
+        rating_user_matrix = data.user_rating_matrix.transpose(copy=True)
+        user_row = data.similarity_matrix.getrow(data.uid_target_number[user])
         similarities = np.asarray(user_row.copy().todense()).ravel()
-        evaluated_items = non_personalized_init(rec_length, user)
-        candidates = []
-        already_seen = DataContainer.user_rated_items[user]
-        for neighbour in DataContainer.user_neighbours[user]:
-            if neighbour in DataContainer.user_rated_items.keys():
-                candidates.extend(DataContainer.user_rated_items[neighbour])
-        candidates = list(set(candidates))
+        evaluated_items = non_personalized_init(data, rec_length, user)
+        already_seen = data.user_items(data.uid_to_urm_position[user])
+        # The candidates are the items rated by the neighbours (rows of the urm), read from its CSR layout
+        candidates = np.unique(np.concatenate([np.zeros(0, dtype=already_seen.dtype)] +
+                                              [data.user_items(neighbour)
+                                               for neighbour in data.user_neighbours[user]]))
         candidates_filtered = (x for x in candidates
-                               if x not in DataContainer.expired_items and x not in already_seen)
-        if user in DataContainer.user_rated_items.keys():
+                               if x not in data.expired_items and x not in already_seen)
+        if len(already_seen) > 0:
             for item in candidates_filtered:
                 item_column = rating_user_matrix.getrow(item).T
-                rankers = [x for x in DataContainer.user_neighbours[user] if x in DataContainer.item_rating_users[item]]
+                rankers = np.intersect1d(data.user_neighbours[user], data.item_users(item))
                 summation = 0
                 for ranker in rankers:
                     summation += similarities[ranker]
@@ -323,34 +310,20 @@ def recommender(start, end, rec_length, thread_number):
     return dictionary
 
 
-def non_personalized_init(rec_length, user):
-    # For reasons of time this function is absolutely data-set dependent. TODO make it independent
-    top_100_pops = [1053452, 2778525, 1244196, 1386412, 657183, 2791339, 536047, 2002097, 1092821, 784737, 1053542,
-                    278589, 79531, 1928254, 1133414, 1162250, 1984327, 343377, 1742926, 1233470, 1140869, 830073,
-                    460717, 1576126, 2532610, 1443706, 1201171, 2593483, 1056667, 1754395, 1237071, 1117449, 734196,
-                    437245, 266412, 2371338, 823512, 2106311, 1953846, 2413494, 2796479, 1776330, 365608, 1165605,
-                    2031981, 2402625, 1679143, 2487208, 315676, 1069281, 818215, 419011, 931519, 470426, 1695664,
-                    2795800, 2313894, 1119495, 2091019, 2086041, 84304, 72465, 499178, 2156629, 906846, 468120,
-                    1427250, 117018, 471520, 2466095, 1920047, 1830993, 2198329, 335428, 2512859, 1500071, 2037855,
-                    434392, 951143, 972388, 1047625, 2350341, 2712481, 542469, 1123592, 152021, 1244787, 1899627,
-                    625711, 1330328, 2462072, 1419444, 2590849, 1486097, 1788671, 2175889, 110711,
-                    16356, 291669, 313851]
-
+def non_personalized_init(data, rec_length, user):
+    # Returns the first rec_length popular items not seen by the user, with decreasing negative weights. The
+    # ranking is computed on the URM, the expired items are already left out of it
+    seen_items = set(data.urm_position_to_iid[item]
+                     for item in data.user_items(data.uid_to_urm_position[user]).tolist())
     to_recommend = []
     weight = -2
-    counter = 0
-    for item in top_100_pops:
-        if item not in DataContainer.expired_items and item not in DataContainer.user_rated_items[user]:
+    for item in data.popular_items:
+        if item not in seen_items:
             to_recommend.append((item, weight))
             weight -= 1
-            counter += 1
-            if counter == rec_length:
+            if len(to_recommend) == rec_length:
                 break
 
-    for i in range(0, rec_length - counter):
-        to_recommend.append((0, weight))
-        weight -= 1
-
     return to_recommend
 
 
@@ -361,15 +334,29 @@ def writing():
 
 def main():
     u.init(int(time.time()*1000), args.verbosity_level, "UB_CF")
-    DataContainer.user_rating_dictionary, DataContainer.number_of_users, DataContainer.number_of_items,\
-        DataContainer.target_users, DataContainer.users, DataContainer.urm_position_to_uid, \
-        DataContainer.uid_to_urm_position, DataContainer.urm_position_to_iid, DataContainer.iid_to_urm_position =\
-        u.data_importation(args.rating_file, args.target_users, args.user_key, args.item_key, args.rating_key)
-    urm_computer()
-    similarity_matrix_computer()
-    DataContainer.expired_items = u.check_expiration("data/competition/item_profile.csv")
-    recommender(0, len(DataContainer.target_users), args.rec_length, 1)
-
-main()
+    data = DataContainer()
+    importation = u.columnar_importation if args.ingestion_mode == "columnar" else u.data_importation
+    # The interactions are the COO arrays (rows, cols, values) in columnar mode, the dictionary of the user
+    # ratings otherwise
+    interactions, data.number_of_users, data.number_of_items,\
+        data.target_users, data.users, data.urm_position_to_uid, \
+        data.uid_to_urm_position, data.urm_position_to_iid, data.iid_to_urm_position =\
+        importation(args.rating_file, args.target_users, args.user_key, args.item_key, args.rating_key)
+    if args.ingestion_mode == "columnar":
+        coo_urm_computer(data, *interactions)
+    else:
+        data.user_rating_dictionary = interactions
+        urm_computer(data)
+    similarity_matrix_computer(data)
+    data.expired_items = u.check_expiration("data/competition/item_profile.csv")
+    data.popular_items = u.popularity_ranking(data.user_rating_matrix,
+                                                       data.urm_position_to_iid, data.expired_items)
+    data.rec_dictionary = recommender(data, 0, len(data.target_users), args.rec_length, 1)
+    return data
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
 
 
@@ -53,20 +53,20 @@ class Utils:
         # Here the program fills the array with all the users to be recommended
         # after this if/else target_users contains this information
         Utils.time_print("Listing the target users", style="Info")
-        interacting_users = interactions_reader[user_key].as_matrix()
+        interacting_users = interactions_reader[user_key].values
         if target_users_file is None:
             target_users = interacting_users
             users = interacting_users
         else:
             with open(target_users_file, 'r') as t:
                 target_users_reader = pd.read_csv(target_users_file, delimiter='\t')
-            target_users = target_users_reader[user_key].as_matrix()
+            target_users = target_users_reader[user_key].values
             users = list(set(np.hstack((target_users, interacting_users))))
             t.close()
 
         # Computes the size of the user rating matrix using a simple parallel splitting to increase the speed
         Utils.time_print("Defining the dimension of the URM and mapping", style="Info")
-        items = list(set(interactions_reader[item_key].as_matrix()))
+        items = list(set(interactions_reader[item_key].values))
         pool = multiprocessing.Pool()
         position_iid_dic_process = pool.apply_async(Utils.mapper, (items, "Items",))
         iid_position_dic, position_iid_dic = position_iid_dic_process.get()
@@ -96,6 +96,64 @@ class Utils:
         return temp_dic, row_number, col_number, target_users, users, position_uid_dic, \
             uid_position_dic, position_iid_dic, iid_position_dic
 
+    @staticmethod
+    def columnar_importation(interactions, target_users_file=None, user_key="user_id", item_key="item_id",
+                             rating_key="rating"):
+        # Same contract of data_importation, but the interactions are returned as three aligned COO arrays
+        # (rows, cols, values). Ids are factorized into integer codes and the duplicated couples are summed
+        # with array operations, without building any dictionary indexed by interaction
+        interactions_reader = pd.read_csv(interactions, delimiter='\t', usecols=[user_key, item_key, rating_key])
+
+        Utils.time_print("Listing the target users", style="Info")
+        interacting_users = interactions_reader[user_key].values
+        if target_users_file is None:
+            target_users = pd.unique(interacting_users)
+        else:
+            target_users = pd.read_csv(target_users_file, delimiter='\t')[user_key].values
+
+        # Target users come first so that also the ones without interactions get a row
+        Utils.time_print("Factorizing the user and item ids", style="Info")
+        user_codes, users = pd.factorize(np.hstack((target_users, interacting_users)))
+        row_ind = user_codes[len(target_users):]
+        col_ind, items = pd.factorize(interactions_reader[item_key].values)
+        ratings = interactions_reader[rating_key].values
+        del interactions_reader
+
+        row_number = len(users)
+        col_number = len(items)
+        position_uid_dic = dict(enumerate(users.tolist()))
+        uid_position_dic = dict(zip(users.tolist(), range(row_number)))
+        position_iid_dic = dict(enumerate(items.tolist()))
+        iid_position_dic = dict(zip(items.tolist(), range(col_number)))
+
+        # Every couple becomes a linear index, duplicates are summed by a bincount over the unique indices
+        Utils.time_print("Aggregating the duplicated interactions", style="Info")
+        linear_ind = row_ind.astype(np.int64) * col_number + col_ind
+        linear_ind, inverse = np.unique(linear_ind, return_inverse=True)
+        data = np.bincount(inverse.ravel(), weights=ratings, minlength=len(linear_ind))
+
+        return (linear_ind // col_number, linear_ind % col_number, data), row_number, col_number, target_users, \
+            users, position_uid_dic, uid_position_dic, position_iid_dic, iid_position_dic
+
+    @staticmethod
+    def remove_biases(row_indices, col_indices, values, row_number, col_number, user_bias=1, item_bias=1,
+                      user_damping=0, item_damping=0):
+        # Subtracts the user bias (average of the row) and then the item bias (average of the column) from the COO
+        # values, returning the new values and the two arrays of biases. The damping terms shrink the averages of
+        # the rows with few elements towards the global average and the ones of the columns towards zero
+        global_average = values.mean() if len(values) > 0 else 0
+        row_elements = np.bincount(row_indices, minlength=row_number) + user_damping
+        user_average = np.divide(np.bincount(row_indices, weights=values, minlength=row_number) +
+                                 user_damping*global_average, row_elements, out=np.zeros(row_number),
+                                 where=row_elements > 0) * user_bias
+        values = values - user_average[row_indices]
+
+        col_elements = np.bincount(col_indices, minlength=col_number) + item_damping
+        item_average = np.divide(np.bincount(col_indices, weights=values, minlength=col_number), col_elements,
+                                 out=np.zeros(col_number), where=col_elements > 0) * item_bias
+        values -= item_average[col_indices]
+        return values, user_average, item_average
+
     @staticmethod
     def check_expiration(filename):
         # Returns a list in which all the items that are expired are stored
@@ -115,6 +173,16 @@ class Utils:
         # return the list of invalid item_id
         return expired_ids
 
+    @staticmethod
+    def popularity_ranking(user_rating_matrix, position_iid_dic, excluded_ids=()):
+        # Returns the ids of the items sorted by number of users that interacted with them, most popular first,
+        # leaving out the excluded ones (e.g. the expired items) and the ones without interactions
+        popularity = user_rating_matrix.getnnz(axis=0)
+        ranking = np.argsort(-popularity, kind='stable')
+        ranking = ranking[popularity[ranking] > 0]
+        ids = np.array([position_iid_dic[position] for position in ranking.tolist()])
+        return ids[~np.isin(ids, excluded_ids)]
+
     @staticmethod
     def init(time_offset, verbosity_level, name):
         Utils.time_offset = time_offset